@@ -4,11 +4,16 @@ from datetime import datetime
 from typing import Dict, Optional, Any
 
 try:
-    from pymongo import MongoClient
+    from pymongo import MongoClient, UpdateOne
 except Exception:
     MongoClient = None
+    UpdateOne = None
 
 class _MemoryCollection:
+    # update_one は $set / $inc のトップレベルキーのみ対応（$push やドット記法のパスは不可）。
+    # 呼び出し側はこれを見て文書全体の $set に切り替える
+    supports_update_operators = False
+
     def __init__(self, backing: Dict):
         self._b = backing
 
@@ -21,7 +26,8 @@ class _MemoryCollection:
         self._b[_id] = doc
         return {'inserted_id': _id}
 
-    def find_one(self, query: Dict):
+    def find_one(self, query: Dict, projection: Optional[Dict] = None):
+        # projection は pymongo 互換のため受け取るだけ（メモリ版は常に文書全体を返す）
         if not query:
             return None
         if '_id' in query:
@@ -51,6 +57,9 @@ class _MemoryCollection:
         if '$set' in update:
             for k, v in update['$set'].items():
                 target[k] = v
+        if '$inc' in update:
+            for k, v in update['$inc'].items():
+                target[k] = (target.get(k) or 0) + v
         return {'matched_count': 1, 'modified_count': 1}
 
     def delete_one(self, query: Dict):
@@ -260,6 +269,28 @@ class UserModel:
     def get_user_by_username(self, username: str) -> Optional[Dict]:
         return self.dbm.users.find_one({'username': username})
 
+    def bulk_update_after_game(self, winner_id: Any, new_w: int, winner_stat: str,
+                               loser_id: Any, new_l: int, loser_stat: str) -> None:
+        """対局後のレート・戦績（'wins'/'losses'/'draws' と games_played）を両者まとめて更新する。
+        Mongo では bulk_write 1回、メモリDBでは update_one を2回。"""
+        col = self.dbm.users
+        if UpdateOne is not None and hasattr(col, 'bulk_write'):
+            col.bulk_write([
+                UpdateOne({'_id': winner_id}, self._match_result_update(new_w, winner_stat)),
+                UpdateOne({'_id': loser_id}, self._match_result_update(new_l, loser_stat)),
+            ], ordered=False)
+            return
+        self.apply_match_result(winner_id, new_w, winner_stat)
+        self.apply_match_result(loser_id, new_l, loser_stat)
+
+    @staticmethod
+    def _match_result_update(new_rating: int, result_field: str) -> Dict:
+        return {'$set': {'rating': int(new_rating)}, '$inc': {result_field: 1, 'games_played': 1}}
+
+    def apply_match_result(self, user_id: Any, new_rating: int, result_field: str) -> None:
+        """1人分のレートと戦績（result_field と games_played）を update_one 1回で更新する。"""
+        self.dbm.users.update_one({'_id': user_id}, self._match_result_update(new_rating, result_field))
+
     def upsert_user(self, user: Dict) -> str:
         _id = user.get('_id') or str(uuid.uuid4())
         user['_id'] = _id
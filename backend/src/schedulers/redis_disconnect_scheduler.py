@@ -45,3 +45,18 @@ class RedisDisconnectScheduler:
             pipe.execute(); return True
         except Exception as e:
             logger.warning("dc cancel failed: %s", e, exc_info=True); return False
+    def cancel_many(self, game_id: str, user_ids) -> bool:
+        """cancel() for several users of one game: one pipelined read + one pipelined write."""
+        try:
+            keys = [self._ptr_key(game_id, u) for u in user_ids if u]
+            if not keys: return True
+            pipe = self.redis.pipeline()
+            for k in keys: pipe.get(k)
+            prevs = pipe.execute()
+            pipe = self.redis.pipeline()
+            for k, prev in zip(keys, prevs):
+                if prev:
+                    pipe.zrem(self.zset_key, prev); pipe.delete(k)
+            pipe.execute(); return True
+        except Exception as e:
+            logger.warning("dc cancel_many failed: %s", e, exc_info=True); return False
@@ -3,6 +3,7 @@ from flask import current_app
 from bson import ObjectId
 from typing import Any, Dict, Optional, List
 from datetime import datetime, timezone
+import random
 from src.presence_utils import get_db
 from src.utils.clock import epoch_ms
 
@@ -12,6 +13,35 @@ try:
 except Exception:  # pragma: no cover
     DuplicateKeyError = Exception  # type: ignore
 
+# --- finish hooks (resolved once; None when unavailable) ---
+try:
+    from src.services.analysis_queue import try_enqueue_game_analysis
+except ImportError:  # pragma: no cover
+    try_enqueue_game_analysis = None  # type: ignore
+
+try:
+    from src.utils.system_chat import emit_game_end_system_chat
+except ImportError:  # pragma: no cover
+    emit_game_end_system_chat = None  # type: ignore
+
+# 遅着猶予（config.py の TIMEOUT_GRACE_SECONDS * 1000ms）
+try:
+    from ..config import TIMEOUT_GRACE_SECONDS as _GRACE_SEC
+    _DEFAULT_GRACE_MS = int(_GRACE_SEC) * 1000
+except Exception:  # pragma: no cover
+    _DEFAULT_GRACE_MS = 3000
+
+
+def _grace_ms_for(ts: dict) -> int:
+    """Late-move grace in ms; per-game time_state.config.time_grace_ms overrides (0 disables)."""
+    try:
+        gcfg = ts.get('config') or {}
+        if gcfg.get('time_grace_ms') is not None:
+            return int(gcfg.get('time_grace_ms') or 0)
+    except Exception:
+        pass
+    return _DEFAULT_GRACE_MS
+
 
 def _get_db_collection(db, name: str):
     """Get a collection/collection-like object from MongoDB Database or MemoryDB.
@@ -113,11 +143,6 @@ def _finalize_post_game_lock(db, game_id: str, now_dt: datetime, status: str, pa
 
 def _json_safe(obj: Any):
     """Convert Mongo / datetime values into JSON-serializable shapes (recursive)."""
-    try:
-        from bson import ObjectId as _OID  # type: ignore
-    except Exception:
-        _OID = None
-
     if isinstance(obj, datetime):
         dt = obj
         try:
@@ -128,7 +153,7 @@ def _json_safe(obj: Any):
             pass
         return dt.isoformat().replace("+00:00", "Z")
 
-    if _OID is not None and isinstance(obj, _OID):
+    if isinstance(obj, ObjectId):
         return str(obj)
 
     if isinstance(obj, dict):
@@ -304,19 +329,207 @@ def _must_promote(role: str, piece: str, r2: int) -> bool:
 
 # === repetition / check helpers =================================================
 
-def _normalize_sfen_key(sfen: str) -> Optional[str]:
-    """Normalize SFEN to a repetition key (board + side-to-move + hands), excluding ply."""
-    if not isinstance(sfen, str):
-        return None
-    s = sfen.strip()
-    if not s:
-        return None
-    if s == 'startpos':
-        s = DEFAULT_START_SFEN
-    parts = s.split()
-    if len(parts) < 3:
+# --- Zobrist hashing (repetition keys) ---
+# Keys are persisted in game docs, so the tables must be identical across
+# processes and restarts: they come from a fixed-seed PRNG, never reseed.
+_ZOBRIST_PIECES = (
+    'pawn', 'lance', 'knight', 'silver', 'gold', 'bishop', 'rook', 'king',
+    'promoted_pawn', 'promoted_lance', 'promoted_knight', 'promoted_silver',
+    'promoted_bishop', 'promoted_rook',
+)
+_ZOBRIST_HAND_PIECES = ('pawn', 'lance', 'knight', 'silver', 'gold', 'bishop', 'rook')
+_ZOBRIST_HAND_MAX = 18  # 18 pawns is the most any side can hold
+
+
+def _build_zobrist_tables():
+    rng = random.Random(0x5C365_2B0A4D)
+    board = {}
+    for owner in ('sente', 'gote'):
+        for piece in _ZOBRIST_PIECES:
+            board[(owner, piece)] = tuple(rng.getrandbits(64) for _ in range(81))
+    hand = {}
+    for owner in ('sente', 'gote'):
+        for piece in _ZOBRIST_HAND_PIECES:
+            # index = count held; count 0 hashes to 0 so empty hands need no entry
+            hand[(owner, piece)] = (0,) + tuple(rng.getrandbits(64) for _ in range(_ZOBRIST_HAND_MAX))
+    side = rng.getrandbits(64)
+    return board, hand, side
+
+
+_Z_BOARD, _Z_HAND, _Z_SIDE = _build_zobrist_tables()
+_ZOBRIST_KEY_TYPE = 'zobrist64'
+
+
+class _BoundedCache:
+    """Fixed-capacity memo (oldest entry evicted first) for pure position evaluations."""
+    __slots__ = ('_data', '_maxsize')
+
+    def __init__(self, maxsize: int):
+        self._data: dict = {}
+        self._maxsize = maxsize
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def put(self, key, value) -> None:
+        d = self._data
+        if key not in d and len(d) >= self._maxsize:
+            try:
+                d.pop(next(iter(d)))
+            except (StopIteration, KeyError, RuntimeError):
+                pass
+        d[key] = value
+
+
+# Results are pure functions of the position, so entries never need invalidating.
+_MATE_CACHE = _BoundedCache(65536)
+_NYUGYOKU_CACHE = _BoundedCache(65536)
+_MISS = object()
+
+
+def _zobrist_key(h: int) -> str:
+    return f"{h:016x}"
+
+
+def _zobrist_full(board: list, hands: dict, turn: str) -> int:
+    """Hash a whole position (board + hands + side to move); ply is not part of it."""
+    h = 0
+    for r in range(9):
+        row = board[r]
+        for c in range(9):
+            cell = row[c]
+            if cell:
+                h ^= _Z_BOARD[(cell['owner'], cell['piece'])][r * 9 + c]
+    for owner in ('sente', 'gote'):
+        for piece, n in ((hands or {}).get(owner) or {}).items():
+            n = int(n or 0)
+            if n > 0:
+                h ^= _Z_HAND[(owner, piece)][n]
+    if turn == 'gote':
+        h ^= _Z_SIDE
+    return h
+
+
+def _zobrist_after_move(h: int, board: list, hands: dict, role: str, move_rec: dict) -> int:
+    """Update h for move_rec (from _apply_legal_usi_move) played by role on the pre-move board/hands."""
+    bag = (hands or {}).get(role) or {}
+    to = move_rec['to']
+    sq2 = to['r'] * 9 + to['c']
+    if move_rec.get('type') == 'drop':
+        piece = move_rec['piece']
+        n = int(bag.get(piece) or 0)
+        hz = _Z_HAND[(role, piece)]
+        h ^= hz[n] ^ hz[n - 1]
+    else:
+        fr = move_rec['from']
+        src = board[fr['r']][fr['c']]
+        h ^= _Z_BOARD[(role, src['piece'])][fr['r'] * 9 + fr['c']]
+        dst = board[to['r']][to['c']]
+        if dst:
+            h ^= _Z_BOARD[(dst['owner'], dst['piece'])][sq2]
+            cap = _to_base_piece(dst['piece'])
+            n = int(bag.get(cap) or 0)
+            hz = _Z_HAND[(role, cap)]
+            h ^= hz[n] ^ hz[n + 1]
+    h ^= _Z_BOARD[(role, move_rec['piece'])][sq2]
+    return h ^ _Z_SIDE
+
+
+def _sfen_key_to_zobrist(key: str) -> Optional[str]:
+    """Convert a legacy repetition key ('board turn hands') to a Zobrist key."""
+    parsed = _parse_sfen(f"{key} 1") if isinstance(key, str) else None
+    if not parsed:
         return None
-    return ' '.join(parts[:3])
+    return _zobrist_key(_zobrist_full(parsed['board'], parsed['hands'], parsed['turn']))
+
+
+# Occurrences kept per repetition key; 4 are enough to bound the perpetual-check segment.
+# History is never flushed on captures/drops: unlike chess pawn moves, a captured
+# piece returns to play as a drop, so an earlier position (hands included) can recur.
+_REPETITION_KEEP = 4
+
+
+def _load_repetition(rep: Any, cur_index: int) -> dict:
+    """Copy the stored repetition subdoc into {counts, last_indices, last_key, last_index}.
+
+    Position index i is the position after i moves (0 = start position).
+    Legacy docs stored the full `keys` list (keys[-1] == position cur_index);
+    it is converted once into per-key occurrence indices. Legacy SFEN-string
+    keys are re-keyed to Zobrist keys.
+    """
+    rep = rep if isinstance(rep, dict) else {}
+    counts = {k: int(v or 0) for k, v in (rep.get('counts') or {}).items()}
+    last_indices = {k: list(v) for k, v in (rep.get('last_indices') or {}).items() if isinstance(v, list)}
+    last_key = rep.get('last_key')
+    last_index = rep.get('last_index')
+
+    keys = rep.get('keys')
+    if isinstance(keys, list) and keys and not last_indices:
+        base = cur_index - (len(keys) - 1)
+        for i, k in enumerate(keys):
+            last_indices.setdefault(k, []).append(base + i)
+        for k in last_indices:
+            last_indices[k] = last_indices[k][-_REPETITION_KEEP:]
+        last_key, last_index = keys[-1], cur_index
+
+    if rep.get('key') != _ZOBRIST_KEY_TYPE and (counts or last_indices):
+        # legacy SFEN-string keys -> Zobrist keys (one-time, per distinct position)
+        conv = {k: _sfen_key_to_zobrist(k) for k in set(counts) | set(last_indices)}
+        z_counts: dict = {}
+        z_indices: dict = {}
+        for k, z in conv.items():
+            if z is None:
+                continue
+            z_counts[z] = z_counts.get(z, 0) + counts.get(k, 0)
+            if k in last_indices:
+                z_indices[z] = sorted(z_indices.get(z, []) + last_indices[k])[-_REPETITION_KEEP:]
+        counts, last_indices = z_counts, z_indices
+        last_key = conv.get(last_key)
+
+    return {
+        'key': _ZOBRIST_KEY_TYPE,
+        'counts': counts,
+        'last_indices': last_indices,
+        'last_key': last_key,
+        'last_index': last_index,
+    }
+
+
+def _record_repetition(rep: dict, key: str, index: int) -> int:
+    """Count one more occurrence of key at position index; return the new count."""
+    c = rep['counts'].get(key, 0) + 1
+    rep['counts'][key] = c
+    occ = rep['last_indices'].setdefault(key, [])
+    occ.append(index)
+    if len(occ) > _REPETITION_KEEP:
+        del occ[:-_REPETITION_KEEP]
+    rep['last_key'] = key
+    rep['last_index'] = index
+    return c
+
+
+def _perpetual_check_offender(move_hist: list, i_start: int) -> Optional[str]:
+    """Return the side whose every move since i_start gave check (only one side), else None."""
+    seen = {'sente': False, 'gote': False}
+    all_check = {'sente': True, 'gote': True}
+    # Walk back from the latest move (no slice copy); once both sides have made a
+    # non-checking move the answer is None whatever the older moves were.
+    for i in range(len(move_hist) - 1, max(i_start, 0) - 1, -1):
+        m = move_hist[i]
+        by = m.get('by')
+        if by in seen:
+            seen[by] = True
+            if not m.get('check'):
+                all_check[by] = False
+                if not (all_check['sente'] or all_check['gote']):
+                    return None
+    sente_all = seen['sente'] and all_check['sente']
+    gote_all = seen['gote'] and all_check['gote']
+    if sente_all and not gote_all:
+        return 'sente'
+    if gote_all and not sente_all:
+        return 'gote'
+    return None
 
 
 def _find_king(board: list, role: str):
@@ -324,7 +537,7 @@ def _find_king(board: list, role: str):
         for r in range(9):
             for c in range(9):
                 cell = board[r][c]
-                if cell and str(cell.get('owner')) == role and str(cell.get('piece')) == 'king':
+                if cell and cell.get('owner') == role and cell.get('piece') == 'king':
                     return (r, c)
     except Exception:
         return None
@@ -389,7 +602,7 @@ def _compute_nyugyoku_stats(board: list, hands: dict, role: str) -> dict:
                 cell = board[r][c]
                 if not cell:
                     continue
-                if str(cell.get('owner')) != str(role):
+                if cell.get('owner') != role:
                     continue
                 piece = str(cell.get('piece') or '')
                 if piece == 'king':
@@ -437,7 +650,7 @@ def _compute_nyugyoku_stats(board: list, hands: dict, role: str) -> dict:
         'in_check': bool(in_check),
     }
 
-def _evaluate_nyugyoku_outcome(board: list, hands: dict, move_count: int) -> Optional[dict]:
+def _evaluate_nyugyoku_outcome(board: list, hands: dict, move_count: int, *, zkey: Optional[int] = None) -> Optional[dict]:
     """Evaluate nyugyoku/jishogi end condition.
 
     Rules (as requested):
@@ -449,6 +662,8 @@ def _evaluate_nyugyoku_outcome(board: list, hands: dict, move_count: int) -> Opt
           * If a side has entered and points_total < 10 -> lose
       - At 256 moves: if not finished earlier -> draw
 
+    zkey: Zobrist hash of the position if the caller has it (memo key).
+
     Returns:
       None or {winner_role, loser_role, reason, extra_set}
     """
@@ -467,6 +682,32 @@ def _evaluate_nyugyoku_outcome(board: list, hands: dict, move_count: int) -> Opt
         }
         return {'winner_role': 'draw', 'loser_role': 'draw', 'reason': 'jishogi_256', 'extra_set': extra}
 
+    try:
+        k = zkey if zkey is not None else _zobrist_full(board, hands, 'sente')
+    except Exception:
+        k = None
+    res = _NYUGYOKU_CACHE.get(k, _MISS) if k is not None else _MISS
+    if res is _MISS:
+        res = _nyugyoku_core(board, hands)
+        if k is not None:
+            _NYUGYOKU_CACHE.put(k, res)
+    if res is None:
+        return None
+    stats, (winner, loser, reason) = res
+    extra = {
+        'nyugyoku_eval': {
+            'move_count': int(mc),
+            'stats': {r: dict(st) for r, st in stats.items()},
+        }
+    }
+    return {'winner_role': winner, 'loser_role': loser, 'reason': reason, 'extra_set': extra}
+
+
+def _nyugyoku_core(board: list, hands: dict):
+    """Move-count independent part of _evaluate_nyugyoku_outcome.
+
+    Returns None or (stats, (winner_role, loser_role, reason)).
+    """
     stats = {}
     entered = []
     for r in ('sente', 'gote'):
@@ -501,40 +742,27 @@ def _evaluate_nyugyoku_outcome(board: list, hands: dict, move_count: int) -> Opt
         ):
             win_sides.append(r)
 
-    extra = {
-        'nyugyoku_eval': {
-            'move_count': int(mc),
-            'stats': stats,
-        }
-    }
-
     # win
     if len(win_sides) == 1:
         w = win_sides[0]
-        return {
-            'winner_role': w,
-            'loser_role': ('gote' if w == 'sente' else 'sente'),
-            'reason': 'nyugyoku',
-            'extra_set': extra,
-        }
+        return stats, (w, ('gote' if w == 'sente' else 'sente'), 'nyugyoku')
     if len(win_sides) >= 2:
-        return {'winner_role': 'draw', 'loser_role': 'draw', 'reason': 'nyugyoku_both', 'extra_set': extra}
+        return stats, ('draw', 'draw', 'nyugyoku_both')
 
     # lose (low points)
     if len(lose_sides) == 1:
         l = lose_sides[0]
-        return {
-            'winner_role': ('gote' if l == 'sente' else 'sente'),
-            'loser_role': l,
-            'reason': 'nyugyoku_low_points',
-            'extra_set': extra,
-        }
+        return stats, (('gote' if l == 'sente' else 'sente'), l, 'nyugyoku_low_points')
     if len(lose_sides) >= 2:
-        return {'winner_role': 'draw', 'loser_role': 'draw', 'reason': 'nyugyoku_low_points_both', 'extra_set': extra}
+        return stats, ('draw', 'draw', 'nyugyoku_low_points_both')
 
     return None
 
 
+# Below this many plies as_api_payload skips the nyugyoku safety-net scan.
+_NYUGYOKU_MIN_PLY = 60
+
+
 def _attacks_square(board: list, r: int, c: int, piece: str, owner: str, tr: int, tc: int) -> bool:
     """Return True if the piece at (r,c) attacks target square (tr,tc) (pseudo-legal, ignores self-check)."""
     try:
@@ -623,7 +851,7 @@ def _is_king_in_check(board: list, defender_role: str) -> bool:
                 cell = board[r][c]
                 if not cell:
                     continue
-                if str(cell.get('owner')) != attacker:
+                if cell.get('owner') != attacker:
                     continue
                 if _attacks_square(board, r, c, str(cell.get('piece')), attacker, tr, tc):
                     return True
@@ -674,9 +902,9 @@ def _has_unpromoted_pawn_on_file(board: list, role: str, col: int) -> bool:
             cell = board[r][col]
             if not cell:
                 continue
-            if str(cell.get('owner')) != role:
+            if cell.get('owner') != role:
                 continue
-            if str(cell.get('piece')) == 'pawn':
+            if cell.get('piece') == 'pawn':
                 return True
     except Exception:
         return False
@@ -739,11 +967,11 @@ def _apply_legal_usi_move(board: list, hands: dict, role: str, spec: dict, *, de
 
         src = nb[r1][c1]
         dst = nb[r2][c2]
-        if not (isinstance(src, dict) and str(src.get('owner')) == role):
+        if not (isinstance(src, dict) and src.get('owner') == role):
             return {'ok': False, 'message': 'no_piece_or_not_owner'}
-        if isinstance(dst, dict) and str(dst.get('owner')) == role:
+        if isinstance(dst, dict) and dst.get('owner') == role:
             return {'ok': False, 'message': 'occupied_by_self'}
-        if isinstance(dst, dict) and str(dst.get('piece')) == 'king':
+        if isinstance(dst, dict) and dst.get('piece') == 'king':
             return {'ok': False, 'message': 'cannot_capture_king'}
 
         orig_piece = str(src.get('piece') or '')
@@ -849,7 +1077,125 @@ def _apply_legal_usi_move(board: list, hands: dict, role: str, spec: dict, *, de
     return {'ok': False, 'message': 'bad_payload'}
 
 
-def _side_has_any_legal_move(board: list, hands: dict, role: str, *, depth: int = 0) -> bool:
+# --- pseudo-legal target tables (built once at import) ---
+# Step targets per (owner, piece) and square index r*9+c, and sliding directions
+# per (owner, piece), so move generation only visits reachable squares instead of
+# testing all 81 targets with _attacks_square.
+
+def _step_dirs(owner: str, piece: str) -> tuple:
+    f = -1 if owner == 'sente' else 1
+    b = -f
+    gold = ((f, 0), (f, -1), (f, 1), (0, -1), (0, 1), (b, 0))
+    return {
+        'king': ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)),
+        'gold': gold,
+        'promoted_pawn': gold,
+        'promoted_lance': gold,
+        'promoted_knight': gold,
+        'promoted_silver': gold,
+        'silver': ((f, 0), (f, -1), (f, 1), (b, -1), (b, 1)),
+        'pawn': ((f, 0),),
+        'knight': ((2 * f, -1), (2 * f, 1)),
+        'promoted_bishop': ((1, 0), (-1, 0), (0, 1), (0, -1)),
+        'promoted_rook': ((1, 1), (1, -1), (-1, 1), (-1, -1)),
+    }.get(piece, ())
+
+
+def _slide_dirs(owner: str, piece: str) -> tuple:
+    f = -1 if owner == 'sente' else 1
+    diag = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+    orth = ((1, 0), (-1, 0), (0, 1), (0, -1))
+    return {
+        'lance': ((f, 0),),
+        'bishop': diag,
+        'promoted_bishop': diag,
+        'rook': orth,
+        'promoted_rook': orth,
+    }.get(piece, ())
+
+
+def _build_target_tables():
+    step = {}
+    slide = {}
+    for owner in ('sente', 'gote'):
+        for piece in _ZOBRIST_PIECES:
+            dirs = _step_dirs(owner, piece)
+            step[(owner, piece)] = tuple(
+                tuple((r + dr, c + dc) for dr, dc in dirs if 0 <= r + dr < 9 and 0 <= c + dc < 9)
+                for r in range(9) for c in range(9)
+            )
+            slide[(owner, piece)] = _slide_dirs(owner, piece)
+    return step, slide
+
+
+_STEP_TARGETS, _SLIDE_DIRS = _build_target_tables()
+_LEGACY_PIECE_NAMES = {'horse': 'promoted_bishop', 'dragon': 'promoted_rook'}
+_SLIDERS = frozenset(('lance', 'bishop', 'rook', 'promoted_bishop', 'promoted_rook'))
+
+
+def _pseudo_targets(board: list, r: int, c: int, piece: str, owner: str):
+    """Yield squares the piece at (r, c) attacks that are not occupied by its owner."""
+    piece = _LEGACY_PIECE_NAMES.get(piece, piece)
+    key = (owner, piece)
+    for r2, c2 in _STEP_TARGETS.get(key, ((),) * 81)[r * 9 + c]:
+        dst = board[r2][c2]
+        if not dst or dst.get('owner') != owner:
+            yield r2, c2
+    for dr, dc in _SLIDE_DIRS.get(key, ()):
+        r2, c2 = r + dr, c + dc
+        while 0 <= r2 < 9 and 0 <= c2 < 9:
+            dst = board[r2][c2]
+            if dst:
+                if dst.get('owner') != owner:
+                    yield r2, c2
+                break
+            yield r2, c2
+            r2 += dr
+            c2 += dc
+
+
+def _check_block_squares(board: list, role: str) -> list:
+    """Empty squares where a drop could block the check on role's king.
+
+    Only a single sliding checker at distance >= 2 can be blocked; adjacent,
+    knight and double checks leave no useful drop squares.
+    """
+    kp = _find_king(board, role)
+    if not kp:
+        return []
+    kr, kc = kp
+    attacker = 'gote' if role == 'sente' else 'sente'
+    checkers = []
+    for r in range(9):
+        for c in range(9):
+            cell = board[r][c]
+            if cell and cell.get('owner') == attacker and _attacks_square(board, r, c, str(cell.get('piece')), attacker, kr, kc):
+                checkers.append((r, c, _LEGACY_PIECE_NAMES.get(cell.get('piece'), cell.get('piece'))))
+                if len(checkers) > 1:
+                    return []
+    if not checkers:
+        return []
+    cr, cc, piece = checkers[0]
+    dr, dc = kr - cr, kc - cc
+    if piece not in _SLIDERS or max(abs(dr), abs(dc)) < 2 or not (dr == 0 or dc == 0 or abs(dr) == abs(dc)):
+        return []
+    sr = (dr > 0) - (dr < 0)
+    sc = (dc > 0) - (dc < 0)
+    out = []
+    r, c = cr + sr, cc + sc
+    while (r, c) != (kr, kc):
+        out.append((r, c))
+        r += sr
+        c += sc
+    return out
+
+
+def _side_has_any_legal_move(board: list, hands: dict, role: str, *, depth: int = 0, drop_squares=None) -> bool:
+    """True if role has at least one legal move or drop.
+
+    drop_squares, when given, limits drops to those squares (e.g. the squares
+    that can block a check); None means every empty square.
+    """
     if role not in ('sente', 'gote'):
         return False
 
@@ -860,37 +1206,27 @@ def _side_has_any_legal_move(board: list, hands: dict, role: str, *, depth: int
                 cell = board[r1][c1]
                 if not cell:
                     continue
-                if str(cell.get('owner')) != role:
+                if cell.get('owner') != role:
                     continue
                 piece = str(cell.get('piece') or '')
-                # try all targets (cheap enough: 81)
-                for r2 in range(9):
-                    for c2 in range(9):
-                        if r1 == r2 and c1 == c2:
-                            continue
-                        dst = board[r2][c2]
-                        if isinstance(dst, dict) and str(dst.get('owner')) == role:
-                            continue
-                        if not _attacks_square(board, r1, c1, piece, role, r2, c2):
-                            continue
-
-                        if piece.startswith('promoted_') or piece not in PROMOTABLE:
-                            promote_opts = [False]
+                for r2, c2 in _pseudo_targets(board, r1, c1, piece, role):
+                    if piece.startswith('promoted_') or piece not in PROMOTABLE:
+                        promote_opts = [False]
+                    else:
+                        must = _must_promote(role, piece, r2)
+                        can = _can_promote(role, piece, r1, r2)
+                        if must:
+                            promote_opts = [True]
+                        elif can:
+                            promote_opts = [False, True]
                         else:
-                            must = _must_promote(role, piece, r2)
-                            can = _can_promote(role, piece, r1, r2)
-                            if must:
-                                promote_opts = [True]
-                            elif can:
-                                promote_opts = [False, True]
-                            else:
-                                promote_opts = [False]
-
-                        for pr in promote_opts:
-                            spec = {'is_drop': False, 'from_row': r1, 'from_col': c1, 'to_row': r2, 'to_col': c2, 'promote': bool(pr)}
-                            res = _apply_legal_usi_move(board, hands, role, spec, depth=depth)
-                            if isinstance(res, dict) and res.get('ok'):
-                                return True
+                            promote_opts = [False]
+
+                    for pr in promote_opts:
+                        spec = {'is_drop': False, 'from_row': r1, 'from_col': c1, 'to_row': r2, 'to_col': c2, 'promote': bool(pr)}
+                        res = _apply_legal_usi_move(board, hands, role, spec, depth=depth)
+                        if isinstance(res, dict) and res.get('ok'):
+                            return True
     except Exception:
         pass
 
@@ -898,24 +1234,30 @@ def _side_has_any_legal_move(board: list, hands: dict, role: str, *, depth: int
     try:
         bag = (hands or {}).get(role) or {}
         if isinstance(bag, dict):
+            if drop_squares is None:
+                drop_squares = [(r2, c2) for r2 in range(9) for c2 in range(9)]
             for piece, cnt in list(bag.items()):
                 if int(cnt or 0) <= 0:
                     continue
-                for r2 in range(9):
-                    for c2 in range(9):
-                        if board[r2][c2] is not None:
-                            continue
-                        spec = {'is_drop': True, 'piece_type': str(piece), 'to_row': r2, 'to_col': c2}
-                        res = _apply_legal_usi_move(board, hands, role, spec, depth=depth)
-                        if isinstance(res, dict) and res.get('ok'):
-                            return True
+                for r2, c2 in drop_squares:
+                    if board[r2][c2] is not None:
+                        continue
+                    spec = {'is_drop': True, 'piece_type': str(piece), 'to_row': r2, 'to_col': c2}
+                    res = _apply_legal_usi_move(board, hands, role, spec, depth=depth)
+                    if isinstance(res, dict) and res.get('ok'):
+                        return True
     except Exception:
         pass
 
     return False
 
 
-def _is_checkmate(board: list, hands: dict, defender_role: str, *, depth: int = 0) -> bool:
+def _is_checkmate(board: list, hands: dict, defender_role: str, *, depth: int = 0, zkey: Optional[int] = None) -> bool:
+    """True if defender_role is checkmated.
+
+    zkey: Zobrist hash of the position (side to move = defender_role) if the
+    caller has it; top-level results are memoized by it.
+    """
     if defender_role not in ('sente', 'gote'):
         return False
     if depth > 6:
@@ -925,7 +1267,27 @@ def _is_checkmate(board: list, hands: dict, defender_role: str, *, depth: int =
             return False
     except Exception:
         return False
-    return not _side_has_any_legal_move(board, hands, defender_role, depth=depth)
+
+    # Only depth-0 results are memoized: nested (uchifuzume) searches are depth-limited.
+    k = None
+    if depth == 0:
+        try:
+            k = (zkey if zkey is not None else _zobrist_full(board, hands, defender_role), defender_role)
+        except Exception:
+            k = None
+        hit = _MATE_CACHE.get(k) if k is not None else None
+        if hit is not None:
+            return hit
+
+    # In check, a drop can only help by blocking a single sliding checker.
+    try:
+        blocks = _check_block_squares(board, defender_role)
+    except Exception:
+        blocks = None
+    mated = not _side_has_any_legal_move(board, hands, defender_role, depth=depth, drop_squares=blocks)
+    if k is not None:
+        _MATE_CACHE.put(k, mated)
+    return mated
 
 # === SFEN helpers (canonical on DB / wire) ==================================
 
@@ -1106,6 +1468,92 @@ def _build_sfen(board: list, turn: str, hands: dict, ply: int) -> Optional[str]:
     return f"{b} {t} {h} {p}"
 
 
+class _SideClock:
+    """One side's clock buckets (ms) as slots for the per-move time math.
+
+    time_state keeps the dict form on the wire / in Mongo; convert with
+    from_side() / as_dict() at the edges.
+    """
+    __slots__ = ('initial_ms', 'byoyomi_ms', 'deferment_ms')
+
+    def __init__(self, initial_ms: int = 0, byoyomi_ms: int = 0, deferment_ms: int = 0):
+        self.initial_ms = initial_ms
+        self.byoyomi_ms = byoyomi_ms
+        self.deferment_ms = deferment_ms
+
+    @classmethod
+    def from_side(cls, side) -> "_SideClock":
+        side = side or {}
+        return cls(
+            max(0, int(side.get('initial_ms') or 0)),
+            max(0, int(side.get('byoyomi_ms') or 0)),
+            max(0, int(side.get('deferment_ms') or 0)),
+        )
+
+    def deduct(self, ms: int) -> int:
+        """Consume ms from initial -> byoyomi -> deferment; return the overrun."""
+        take = min(ms, self.initial_ms); ms -= take; self.initial_ms -= take
+        take = min(ms, self.byoyomi_ms); ms -= take; self.byoyomi_ms -= take
+        take = min(ms, self.deferment_ms); ms -= take; self.deferment_ms -= take
+        return ms
+
+    def total(self) -> int:
+        return self.initial_ms + self.byoyomi_ms + self.deferment_ms
+
+    def as_dict(self) -> dict:
+        return {'initial_ms': self.initial_ms, 'byoyomi_ms': self.byoyomi_ms, 'deferment_ms': self.deferment_ms}
+
+
+_ROLES = frozenset(('sente', 'gote'))
+_OPP = {'sente': 'gote', 'gote': 'sente'}
+
+# Shared read-only fallback for missing sub-documents (never mutate).
+_EMPTY: dict = {}
+
+# Keys of as_api_payload() mirrored into the nested "game_state" (plus "players").
+_GAME_STATE_KEYS = (
+    "id", "status", "current_turn", "start_sfen", "sfen", "move_history",
+    "analysis_status", "analysis_progress", "analysis_total", "analysis_error",
+    "analysis_started_at", "analysis_updated_at", "analysis_done_at",
+    "post_game_updates_status", "post_game_updates_result", "post_game_updates_error",
+    "winner", "finished_reason",
+    "time_state", "time_config", "time_effective", "time_effective_breakdown",
+    "spectators",
+)
+
+# Fields get_active_games needs for a lobby row.
+_LOBBY_PROJECTION = {
+    "_id": 1, "status": 1, "current_turn": 1, "updated_at": 1, "time_state": 1,
+    "players.sente.user_id": 1, "players.sente.username": 1,
+    "players.gote.user_id": 1, "players.gote.username": 1,
+}
+
+# make_move / resign_game never read the per-game chat log (up to 100 entries).
+_NO_CHAT_PROJECTION = {"chat_messages": 0}
+
+# --- KIF tables ---
+_PIECE_KANJI = {
+    'pawn': '歩', 'lance': '香', 'knight': '桂', 'silver': '銀',
+    'gold': '金', 'bishop': '角', 'rook': '飛', 'king': '玉',
+    'promoted_pawn': 'と', 'promoted_lance': '成香', 'promoted_knight': '成桂',
+    'promoted_silver': '成銀', 'horse': '馬', 'dragon': '龍',
+    'promoted_bishop': '馬', 'promoted_rook': '龍',
+}
+# 「成」のときは、駒名を成駒にせず「歩成」「角成」などの形にする。
+_PROMO_TO_BASE = {
+    'promoted_pawn': 'pawn',
+    'promoted_lance': 'lance',
+    'promoted_knight': 'knight',
+    'promoted_silver': 'silver',
+    'horse': 'bishop',
+    'dragon': 'rook',
+    'promoted_bishop': 'bishop',
+    'promoted_rook': 'rook',
+}
+_FW_DIGITS = '０１２３４５６７８９'
+_ROW_KAN = ('', '一', '二', '三', '四', '五', '六', '七', '八', '九')
+
+
 class GameService:
     def __init__(self, db, socketio=None, logger=None):
         self.db = db
@@ -1118,6 +1566,17 @@ class GameService:
             self.game_model = db["games"]
         else:
             raise RuntimeError("db.games collection missing")
+        # Mongo applies $push / dotted paths; the memory-DB fallback only top-level $set/$inc.
+        self._delta_updates = bool(getattr(self.game_model, 'supports_update_operators', True))
+        # Lobby listing (get_active_games) filters by status and sorts by updated_at.
+        # Memory DB doesn't support create_index; failures are non-fatal.
+        try:
+            if hasattr(self.game_model, "create_index"):
+                self.game_model.create_index(
+                    [("status", 1), ("updated_at", -1)], name="status_updated_idx", background=True
+                )
+        except Exception:
+            pass
 
     # ---- helpers (placeholders: real project should have concrete impls) -----
     def _now(self):
@@ -1127,31 +1586,13 @@ class GameService:
         base_at = int(ts.get('base_at') or now_ms)
         elapsed = max(0, now_ms - base_at)
 
-        def sum_buckets(side: dict) -> int:
-            ini = max(0, int((side or {}).get('initial_ms') or 0))
-            byo = max(0, int((side or {}).get('byoyomi_ms') or 0))
-            dfr = max(0, int((side or {}).get('deferment_ms') or 0))
-            return ini + byo + dfr
-
-        def deduct(side: dict, ms: int) -> dict:
-            ini = max(0, int((side or {}).get('initial_ms') or 0))
-            byo = max(0, int((side or {}).get('byoyomi_ms') or 0))
-            dfr = max(0, int((side or {}).get('deferment_ms') or 0))
-            take = min(ms, ini); ms -= take; ini -= take
-            take = min(ms, byo); ms -= take; byo -= take
-            take = min(ms, dfr); ms -= take; dfr -= take
-            return {'initial_ms': ini, 'byoyomi_ms': byo, 'deferment_ms': dfr}
-
-        s = dict(ts.get('sente') or {})
-        g = dict(ts.get('gote')  or {})
+        s = _SideClock.from_side(ts.get('sente'))
+        g = _SideClock.from_side(ts.get('gote'))
         if current_turn == 'sente':
-            s_after = deduct(s, elapsed)
-            return sum_buckets(s_after), sum_buckets(g)
+            s.deduct(elapsed)
         elif current_turn == 'gote':
-            g_after = deduct(g, elapsed)
-            return sum_buckets(s), sum_buckets(g_after)
-        else:
-            return sum_buckets(s), sum_buckets(g)
+            g.deduct(elapsed)
+        return s.total(), g.total()
 
 
     def _role_of(self, doc, user_id: str) -> Optional[str]:
@@ -1179,6 +1620,12 @@ class GameService:
             pass
         return None
 
+    @staticmethod
+    def _resolve_turn(doc: dict, ts: Optional[dict] = None) -> str:
+        """Side to move: doc.current_turn -> time_state.current_player -> 'sente'."""
+        t = doc.get('current_turn') or (ts.get('current_player') if isinstance(ts, dict) else None) or 'sente'
+        return t if t in _ROLES else 'sente'
+
     def _opponent(self, role: str) -> str:
         return 'gote' if role == 'sente' else 'sente'
     def _ensure_clock_fields(self, doc):
@@ -1260,30 +1707,14 @@ class GameService:
         now_ms = epoch_ms()
         base_at = int(ts.get('base_at') or now_ms)
         cur = str(doc.get('current_turn') or ts.get('current_player') or 'sente')
-        move_hist = list(doc.get('move_history') or [])
-        ply = len(move_hist) + 1
 
         elapsed = max(0, now_ms - base_at)
 
-        def deduct(side: dict, ms: int):
-            ini = max(0, int(side.get('initial_ms') or 0))
-            byo = max(0, int(side.get('byoyomi_ms') or 0))
-            dfr = max(0, int(side.get('deferment_ms') or 0))
-            take = min(ms, ini); ms -= take; ini -= take
-            take = min(ms, byo); ms -= take; byo -= take
-            take = min(ms, dfr); ms -= take; dfr -= take
-            over = ms
-            return {'initial_ms': ini, 'byoyomi_ms': byo, 'deferment_ms': dfr}, int(elapsed - over), int(over)
-
-        s = dict(ts.get('sente') or {'initial_ms':0,'byoyomi_ms':0,'deferment_ms':0})
-        g = dict(ts.get('gote')  or {'initial_ms':0,'byoyomi_ms':0,'deferment_ms':0})
-
-        if cur == 'sente':
-            s_after, spent, over = deduct(s, elapsed)
-            ts['sente'] = s_after
-        elif cur == 'gote':
-            g_after, spent, over = deduct(g, elapsed)
-            ts['gote'] = g_after
+        if cur in ('sente', 'gote'):
+            side = _SideClock.from_side(ts.get(cur))
+            over = side.deduct(elapsed)
+            spent = elapsed - over
+            ts[cur] = side.as_dict()
         else:
             spent = 0; over = 0
 
@@ -1663,8 +2094,8 @@ class GameService:
         if not isinstance(doc, dict):
             return doc
         game_id = doc.get('_id')
-        move_hist = list(doc.get('move_history') or [])
-        ply = len(move_hist) + 1
+        mh = doc.get('move_history')
+        ply = (len(mh) if isinstance(mh, list) else 0) + 1
 
         start_sfen = doc.get('start_sfen')
         if not (isinstance(start_sfen, str) and len(start_sfen.split()) >= 4):
@@ -1684,8 +2115,7 @@ class GameService:
                         for p in bag:
                             bp = _to_base_piece(str(p))
                             hands[side][bp] = int(hands[side].get(bp) or 0) + 1
-            cur = str(doc.get('current_turn') or (doc.get('time_state') or {}).get('current_player') or 'sente')
-            cur = cur if cur in ('sente', 'gote') else 'sente'
+            cur = self._resolve_turn(doc, doc.get('time_state'))
             built = _build_sfen(board, cur, hands, ply)
             if built:
                 sfen = built
@@ -1693,11 +2123,10 @@ class GameService:
 
         # Persist + cleanup legacy fields.
         try:
-            set_fields = {}
-            if isinstance(doc.get('start_sfen'), str) and len(str(doc.get('start_sfen')).split()) >= 4:
-                set_fields['start_sfen'] = doc.get('start_sfen')
-            if isinstance(doc.get('sfen'), str) and len(str(doc.get('sfen')).split()) >= 4:
-                set_fields['sfen'] = doc.get('sfen')
+            # start_sfen is valid by now; sfen may still be invalid if migration failed.
+            set_fields = {'start_sfen': start_sfen}
+            if isinstance(sfen, str) and len(sfen.split()) >= 4:
+                set_fields['sfen'] = sfen
 
             # Only drop legacy fields once we have a valid canonical SFEN.
             unset_fields = {}
@@ -1740,9 +2169,15 @@ class GameService:
             return None
 
     def _get_player_meta(self, doc: dict) -> dict:
-        players = (doc.get('players') or {}) if isinstance(doc.get('players'), dict) else {}
-        s_pl = (players.get('sente') or {}) if isinstance(players.get('sente'), dict) else {}
-        g_pl = (players.get('gote')  or {}) if isinstance(players.get('gote'),  dict) else {}
+        players = doc.get('players')
+        if not isinstance(players, dict):
+            players = _EMPTY
+        s_pl = players.get('sente')
+        if not isinstance(s_pl, dict):
+            s_pl = _EMPTY
+        g_pl = players.get('gote')
+        if not isinstance(g_pl, dict):
+            g_pl = _EMPTY
 
         s_uid = str(s_pl.get('user_id') or doc.get('sente_id') or '')
         g_uid = str(g_pl.get('user_id') or doc.get('gote_id')  or '')
@@ -1755,19 +2190,25 @@ class GameService:
     def _post_finish_cleanup(self, game_id: str, doc: dict) -> None:
         # Stop scheduled jobs (best-effort): timeout + disconnect.
         try:
-            sch = current_app.config.get('TIMEOUT_SCHEDULER')
+            cfg = current_app.config
+        except Exception:
+            return
+        try:
+            sch = cfg.get('TIMEOUT_SCHEDULER')
             if sch is not None:
                 sch.unschedule_for_game(str(game_id))
         except Exception:
             pass
         try:
-            dcs = current_app.config.get('DC_SCHEDULER')
+            dcs = cfg.get('DC_SCHEDULER')
             if dcs is not None:
                 meta = self._get_player_meta(doc or {})
-                if meta.get('s_uid'):
-                    dcs.cancel(str(game_id), str(meta.get('s_uid')))
-                if meta.get('g_uid'):
-                    dcs.cancel(str(game_id), str(meta.get('g_uid')))
+                uids = [str(u) for u in (meta.get('s_uid'), meta.get('g_uid')) if u]
+                if hasattr(dcs, 'cancel_many'):
+                    dcs.cancel_many(str(game_id), uids)
+                else:
+                    for uid in uids:
+                        dcs.cancel(str(game_id), uid)
         except Exception:
             pass
 
@@ -1788,11 +2229,12 @@ class GameService:
         except Exception:
             pass
 
+        # _get_player_meta already returns str values with defaults applied.
         meta = self._get_player_meta(doc or {})
-        s_uid = str(meta.get('s_uid') or '')
-        g_uid = str(meta.get('g_uid') or '')
-        s_name = str(meta.get('s_name') or '先手')
-        g_name = str(meta.get('g_name') or '後手')
+        s_uid = meta['s_uid']
+        g_uid = meta['g_uid']
+        s_name = meta['s_name']
+        g_name = meta['g_name']
 
         if winner_role in ('sente', 'gote'):
             winner_uid = s_uid if winner_role == 'sente' else g_uid
@@ -1820,9 +2262,13 @@ class GameService:
         except Exception:
             pass
 
+        self._emit_game_end_chat(sio, doc, winner_role, loser_role, reason)
+
+    def _emit_game_end_chat(self, sio, doc: dict, winner_role: str, loser_role: str, reason: str) -> None:
         # system chat: announce game end (persist to chat history; deduped by DB)
+        if emit_game_end_system_chat is None:
+            return
         try:
-            from src.utils.system_chat import emit_game_end_system_chat
             emit_game_end_system_chat(
                 sio,
                 self.game_model,
@@ -1846,28 +2292,33 @@ class GameService:
         disconnect_user_id: str | None = None,
         extra_set: dict | None = None,
         emit: bool = True,
+        doc: dict | None = None,
     ) -> tuple[bool, dict]:
         """End game atomically and run common post-finish steps.
 
+        doc: the caller's current copy of the game; when given, the preflight and
+        post-finish reads are skipped (the finish fields are applied to a copy).
+
         Returns (finished_now, latest_doc).
         """
-        doc0 = None
-        try:
-            doc0 = self.game_model.find_one({'_id': game_id})
-            if doc0 and str(doc0.get('status')) == 'finished':
+        now = self._now()
+        gid = game_id if isinstance(game_id, str) else str(game_id)
+        if doc is not None:
+            doc0 = doc
+            if str(doc0.get('status')) == 'finished':
                 return (False, doc0)
-        except Exception:
+        else:
+            # Preflight: only the status is needed here; the full doc is read after the update.
+            # The projected doc only carries status, so it is not kept as doc0 (the fallback doc below).
             doc0 = None
+            try:
+                head = self.game_model.find_one({'_id': game_id}, {'status': 1})
+                if head and str(head.get('status')) == 'finished':
+                    return (False, self.get_game_by_id(game_id) or head)
+            except Exception:
+                pass
 
-        update = {
-            'status': 'finished',
-            'winner': winner_role,
-            'loser': loser_role,
-            'finished_reason': str(reason),
-            'updated_at': self._now(),
-        }
-        if isinstance(extra_set, dict) and extra_set:
-            update.update(extra_set)
+        update = self._compute_finish_set(winner_role, loser_role, reason, now, extra_set)
 
         try:
             res = self.game_model.update_one({'_id': game_id, 'status': {'$ne': 'finished'}}, {'$set': update})
@@ -1884,18 +2335,71 @@ class GameService:
                 doc_end = doc0 or {}
             return (False, doc_end)
 
+        local = None
+        if doc is not None:
+            local = dict(doc)
+            local.update(update)
+        doc_end = self._after_finish(
+            game_id, winner_role, loser_role, reason,
+            presence_mode=presence_mode,
+            disconnect_user_id=disconnect_user_id,
+            emit=emit,
+            fallback_doc=doc0,
+            doc=local,
+        )
+        return (True, doc_end)
+
+    @staticmethod
+    def _compute_finish_set(winner_role: str, loser_role: str, reason: str, now, extra_set: dict | None = None) -> dict:
+        """$set fields that mark a game finished (shared by finish_game and make_move)."""
+        update = {
+            'status': 'finished',
+            'winner': winner_role,
+            'loser': loser_role,
+            'finished_reason': str(reason),
+            'updated_at': now,
+        }
+        if isinstance(extra_set, dict) and extra_set:
+            update.update(extra_set)
+        return update
+
+    def _after_finish(
+        self,
+        game_id: str,
+        winner_role: str,
+        loser_role: str,
+        reason: str,
+        *,
+        presence_mode: str = 'review',
+        disconnect_user_id: str | None = None,
+        emit: bool = True,
+        fallback_doc: dict | None = None,
+        doc: dict | None = None,
+    ) -> dict:
+        """Common post-finish steps once the finishing write has been acknowledged.
+
+        doc: the finished game as already known in memory (skips the reload).
+        Returns the latest game doc.
+        """
+        gid = game_id if isinstance(game_id, str) else str(game_id)
+        doc0 = fallback_doc
+
         # enqueue engine analysis (best-effort; idempotent on DB)
-        try:
-            from src.services.analysis_queue import try_enqueue_game_analysis
-            try_enqueue_game_analysis(self, str(game_id), redis_url=current_app.config.get("REDIS_URL"))
-        except Exception:
-            pass
+        if try_enqueue_game_analysis is not None:
+            try:
+                cfg = current_app.config
+                try_enqueue_game_analysis(self, gid, redis_url=cfg.get("REDIS_URL"))
+            except Exception:
+                pass
 
-        # reload latest doc for meta/payload
-        try:
-            doc_end = self.get_game_by_id(game_id) or doc0 or {}
-        except Exception:
-            doc_end = doc0 or {}
+        # reload latest doc for meta/payload (unless the caller already has it)
+        if doc is not None:
+            doc_end = doc
+        else:
+            try:
+                doc_end = self.get_game_by_id(game_id) or doc0 or {}
+            except Exception:
+                doc_end = doc0 or {}
 
         # presence
         try:
@@ -1911,14 +2415,14 @@ class GameService:
 
         # stop schedulers
         try:
-            self._post_finish_cleanup(str(game_id), doc_end)
+            self._post_finish_cleanup(gid, doc_end)
         except Exception:
             pass
 
         # rating / stats (idempotent)
         try:
             if hasattr(self, 'apply_post_game_updates'):
-                self.apply_post_game_updates(str(game_id))
+                self.apply_post_game_updates(gid)
                 try:
                     doc_end = self.get_game_by_id(game_id) or doc_end
                 except Exception:
@@ -1928,11 +2432,11 @@ class GameService:
 
         if emit:
             try:
-                self._emit_finished_events(str(game_id), doc_end, winner_role, loser_role, str(reason))
+                self._emit_finished_events(gid, doc_end, winner_role, loser_role, str(reason))
             except Exception:
                 pass
 
-        return (True, doc_end)
+        return doc_end
 
 
 
@@ -1943,14 +2447,14 @@ class GameService:
         - base_at の一致も確認（古い予約ガード）
         """
 
+        gid = game_id if isinstance(game_id, str) else str(game_id)
         doc = self.game_model.find_one({"_id": game_id})
         if not doc or str(doc.get('status')) == 'finished':
             return False
 
         ensured = self._ensure_clock_fields(doc)
         ts = ensured['time_state']
-        cur = str(doc.get('current_turn') or ts.get('current_player') or 'sente')
-        cur = cur if cur in ('sente', 'gote') else 'sente'
+        cur = self._resolve_turn(doc, ts)
 
         # 古い予約なら抜ける
         if base_at_expected is not None:
@@ -1962,26 +2466,15 @@ class GameService:
         _s, _g, spent, over, _bd = self._apply_elapsed(doc)
 
         # grace-inclusive boundary: within grace -> do not finish
-        grace_ms = 3000
-        try:
-            from ..config import TIMEOUT_GRACE_SECONDS
-            grace_ms = int(TIMEOUT_GRACE_SECONDS) * 1000
-        except Exception:
-            pass
-        try:
-            gcfg = ts.get('config') or {}
-            if gcfg.get('time_grace_ms') is not None:
-                grace_ms = int(gcfg.get('time_grace_ms') or 0)
-        except Exception:
-            pass
+        grace_ms = _grace_ms_for(ts)
         if over <= grace_ms:
             return False
 
-        winner_role = self._opponent(cur)
+        winner_role = _OPP[cur]
         loser_role = cur
 
         finished, _doc_end = self.finish_game(
-            game_id=str(game_id),
+            game_id=gid,
             winner_role=winner_role,
             loser_role=loser_role,
             reason='timeout',
@@ -1991,104 +2484,99 @@ class GameService:
         return bool(finished)
 
 
-    def as_api_payload(self, doc, me: Optional[str] = None):
+    def as_api_payload(self, doc, me: Optional[str] = None, *, state: Optional[dict] = None):
+        """Build the client payload for a game doc.
+
+        `state` may carry the already-parsed {board, hands, turn} of doc['sfen']
+        (e.g. from make_move) to avoid parsing the SFEN again.
+        """
         now_ms = epoch_ms()
         doc = self._ensure_sfen_fields(doc)
+        status0 = str(doc.get('status') or '')
 
-
-        # Auto-finish: if an active game position is already checkmated, end it.
-        # (This can happen in legacy DB due to missing legality checks.)
-        try:
-            if str(doc.get('status') or '') != 'finished' and doc.get('_id'):
+        # SFEN is parsed once and shared by the auto-finish checks and the turn lookup below.
+        parsed0 = state
+        if parsed0 is None:
+            try:
                 parsed0 = _parse_sfen(doc.get('sfen') or '')
-                if parsed0 and parsed0.get('turn') in ('sente', 'gote'):
-                    b0 = parsed0.get('board')
-                    h0 = parsed0.get('hands')
-                    t0 = parsed0.get('turn')
-                    if b0 is not None and h0 is not None and _is_checkmate(b0, h0, t0, depth=0):
-                        winner_role = self._opponent(t0)
+            except Exception:
+                parsed0 = None
+
+        # Auto-finish checks only apply to games that are not finished yet.
+        if status0 != 'finished' and doc.get('_id') and parsed0 and parsed0.get('turn') in ('sente', 'gote'):
+            b0 = parsed0.get('board')
+            h0 = parsed0.get('hands')
+
+            # Auto-finish: if an active game position is already checkmated, end it.
+            # (This can happen in legacy DB due to missing legality checks.)
+            try:
+                t0 = parsed0.get('turn')
+                if b0 is not None and h0 is not None and _is_checkmate(b0, h0, t0, depth=0):
+                    winner_role = _OPP[t0]
+                    finished, doc_end = self.finish_game(
+                        game_id=str(doc.get('_id')),
+                        winner_role=winner_role,
+                        loser_role=t0,
+                        reason='checkmate',
+                        presence_mode='review',
+                        emit=True,
+                    )
+                    if finished or str((doc_end or {}).get('status')) == 'finished':
+                        return self.as_api_payload(doc_end, me)
+            except Exception:
+                pass
+
+            # Auto-finish: nyugyoku / long-game (256 moves).
+            # make_move evaluates this on every move; here it is only a safety net for
+            # stale docs, so the opening (where no king can have entered) is skipped.
+            try:
+                mc0 = len(doc.get('move_history') or [])
+                if (
+                    status0 in ('active', 'ongoing', 'in_progress', 'started')
+                    and mc0 >= _NYUGYOKU_MIN_PLY
+                    and b0 is not None and h0 is not None
+                ):
+                    outcome0 = _evaluate_nyugyoku_outcome(b0, h0, mc0)
+                    if isinstance(outcome0, dict) and outcome0.get('reason'):
                         finished, doc_end = self.finish_game(
                             game_id=str(doc.get('_id')),
-                            winner_role=winner_role,
-                            loser_role=t0,
-                            reason='checkmate',
+                            winner_role=str(outcome0.get('winner_role')),
+                            loser_role=str(outcome0.get('loser_role')),
+                            reason=str(outcome0.get('reason')),
                             presence_mode='review',
+                            extra_set=(outcome0.get('extra_set') if isinstance(outcome0.get('extra_set'), dict) else None),
                             emit=True,
                         )
                         if finished or str((doc_end or {}).get('status')) == 'finished':
                             return self.as_api_payload(doc_end, me)
-        except Exception:
-            pass
-
-
-        # Auto-finish: nyugyoku / long-game (256 moves)
-        try:
-            st0 = str(doc.get('status') or '')
-            if st0 in ('active', 'ongoing', 'in_progress', 'started') and doc.get('_id'):
-                parsed0 = _parse_sfen(doc.get('sfen') or '')
-                if parsed0 and parsed0.get('turn') in ('sente', 'gote'):
-                    b0 = parsed0.get('board')
-                    h0 = parsed0.get('hands')
-                    mc0 = len(doc.get('move_history') or [])
-                    if b0 is not None and h0 is not None:
-                        outcome0 = _evaluate_nyugyoku_outcome(b0, h0, mc0)
-                        if isinstance(outcome0, dict) and outcome0.get('reason'):
-                            finished, doc_end = self.finish_game(
-                                game_id=str(doc.get('_id')),
-                                winner_role=str(outcome0.get('winner_role')),
-                                loser_role=str(outcome0.get('loser_role')),
-                                reason=str(outcome0.get('reason')),
-                                presence_mode='review',
-                                extra_set=(outcome0.get('extra_set') if isinstance(outcome0.get('extra_set'), dict) else None),
-                                emit=True,
-                            )
-                            if finished or str((doc_end or {}).get('status')) == 'finished':
-                                return self.as_api_payload(doc_end, me)
-        except Exception:
-            pass
+            except Exception:
+                pass
 
         ensured = self._ensure_clock_fields(doc)
         ts = ensured['time_state']
         # freeze elapsed while paused by overriding base_at during payload computation
-        try:
-            if str(doc.get('status')) == 'pause':
-                ts = dict(ts)
-                ts['base_at'] = now_ms
-        except Exception:
-            pass
+        if status0 == 'pause':
+            ts = dict(ts)
+            ts['base_at'] = now_ms
         # Canonical current turn comes from SFEN if possible.
-        cur = None
-        try:
-            parsed = _parse_sfen(doc.get('sfen') or '')
-            if parsed and parsed.get('turn') in ('sente', 'gote'):
-                cur = parsed.get('turn')
-        except Exception:
-            cur = None
-        cur = str(cur or doc.get('current_turn') or ts.get('current_player') or 'sente')
-        move_hist = list(doc.get('move_history') or [])
-        ply = len(move_hist) + 1
+        cur = parsed0.get('turn') if parsed0 else None
+        if cur not in _ROLES:
+            cur = str(doc.get('current_turn') or ts.get('current_player') or 'sente')
 
         s_eff, g_eff = self._compute_effective_time(ts, cur, now_ms)
 
-        def after_deduct(side: dict, ms: int) -> dict:
-            ini = max(0, int(side.get('initial_ms') or 0))
-            byo = max(0, int(side.get('byoyomi_ms') or 0))
-            dfr = max(0, int(side.get('deferment_ms') or 0))
-            take = min(ms, ini); ms -= take; ini -= take
-            take = min(ms, byo); ms -= take; byo -= take
-            take = min(ms, dfr); ms -= take; dfr -= take
-            return {'initial_ms': ini, 'byoyomi_ms': byo, 'deferment_ms': dfr}
-
         elapsed = max(0, now_ms - int(ts.get('base_at') or now_ms))
-        if cur == 'sente':
-            s_after = after_deduct(dict(ts['sente']), elapsed)
-            g_after = dict(ts['gote'])
-        elif cur == 'gote':
-            g_after = after_deduct(dict(ts['gote']), elapsed)
-            s_after = dict(ts['sente'])
-        else:
-            s_after = dict(ts['sente']); g_after = dict(ts['gote'])
+        s_after = ts['sente']
+        g_after = ts['gote']
+        if cur in ('sente', 'gote'):
+            side = _SideClock.from_side(ts[cur])
+            side.deduct(elapsed)
+            if cur == 'sente':
+                s_after = side.as_dict()
+            else:
+                g_after = side.as_dict()
 
+        specs = doc.get("spectators")
         payload = {
             "id": doc.get("_id"),
             "status": doc.get("status"),
@@ -2115,48 +2603,19 @@ class GameService:
             "time_effective_breakdown": {"sente": s_after, "gote": g_after},
             "time_config": ts.get("config"),
             "updated_at": (doc.get("updated_at") or self._now()).isoformat(),
+            "spectators": specs if isinstance(specs, list) else [],
         }
-        specs = doc.get("spectators")
-        if isinstance(specs, list):
-            payload["spectators"] = specs
-        else:
-            payload["spectators"] = []
-
-        # Nested game_state for FE clients expecting it
-        try:
-            payload_game_state = {
-                "id": payload.get("id"),
-                "status": payload.get("status"),
-                "current_turn": payload.get("current_turn"),
-                "start_sfen": payload.get("start_sfen"),
-                "sfen": payload.get("sfen"),
-                "move_history": payload.get("move_history"),
-                "analysis_status": payload.get("analysis_status"),
-                "analysis_progress": payload.get("analysis_progress"),
-                "analysis_total": payload.get("analysis_total"),
-                "analysis_error": payload.get("analysis_error"),
-                "analysis_started_at": payload.get("analysis_started_at"),
-                "analysis_updated_at": payload.get("analysis_updated_at"),
-                "analysis_done_at": payload.get("analysis_done_at"),
-                "post_game_updates_status": payload.get("post_game_updates_status"),
-                "post_game_updates_result": payload.get("post_game_updates_result"),
-                "post_game_updates_error": payload.get("post_game_updates_error"),
-                "winner": payload.get("winner"),
-                "finished_reason": payload.get("finished_reason"),
-                "players": (doc.get("players") or {}),
-                "time_state": payload.get("time_state"),
-                "time_config": payload.get("time_config"),
-                "time_effective": payload.get("time_effective"),
-                "time_effective_breakdown": payload.get("time_effective_breakdown"),
-                "spectators": payload.get("spectators"),
-            }
-            payload["game_state"] = payload_game_state
-        except Exception:
-            pass
+        # Nested game_state for FE clients expecting it (shares values with payload)
+        payload_game_state = {k: payload[k] for k in _GAME_STATE_KEYS}
+        payload_game_state["players"] = doc.get("players") or _EMPTY
+        payload["game_state"] = payload_game_state
         return _json_safe(payload)
 
 
     def make_move(self, game_id: str, me: str, data: Dict[str, Any]):
+        # One clock read per move: reused for presence, move record and updated_at.
+        now_dt = self._now()
+        now_iso = now_dt.isoformat()
 
 
         # presence: update mover's last_seen_at (upsert)
@@ -2171,10 +2630,7 @@ class GameService:
             me_oid = ObjectId(str(me))
 
 
-            from datetime import datetime, timezone
-
-
-            db['online_users'].update_one({'user_id': me_oid}, {'$set': {'last_seen_at': datetime.now(timezone.utc)}}, upsert=True)
+            db['online_users'].update_one({'user_id': me_oid}, {'$set': {'last_seen_at': now_dt}}, upsert=True)
 
 
         except Exception:
@@ -2182,7 +2638,8 @@ class GameService:
 
             pass
 
-        doc = self.game_model.find_one({"_id": game_id})
+        gid = game_id if isinstance(game_id, str) else str(game_id)
+        doc = self.game_model.find_one({"_id": game_id}, _NO_CHAT_PROJECTION)
         if not doc:
             return {'success': False, 'message': 'not_found'}
 
@@ -2209,14 +2666,15 @@ class GameService:
         try:
             cur_side = str(doc.get('current_turn') or 'sente')
             if cur_side in ('sente', 'gote') and _is_checkmate(board, hands, cur_side, depth=0):
-                winner_role = self._opponent(cur_side)
+                winner_role = _OPP[cur_side]
                 finished, doc_end = self.finish_game(
-                    game_id=str(game_id),
+                    game_id=gid,
                     winner_role=winner_role,
                     loser_role=cur_side,
                     reason='checkmate',
                     presence_mode='review',
                     emit=True,
+                    doc=doc,
                 )
                 if finished or str((doc_end or {}).get('status')) == 'finished':
                     return dict(success=True, **self.as_api_payload(doc_end, me))
@@ -2232,9 +2690,10 @@ class GameService:
         ts = doc['time_state']
         cfg = ts.get('config') or {}
         now_ms = epoch_ms()
+        cur = self._resolve_turn(doc, ts)
         # 再接続前に消費された pending_spent を move の spent に合算し、その後リセット
         try:
-            role_for_spent = str(doc.get('current_turn') or (ts.get('current_player') if isinstance(ts, dict) else '') or 'sente')
+            role_for_spent = cur
             pend_map = ts.get('pending_spent') if isinstance(ts, dict) else None
             pend_ms = 0
             if isinstance(pend_map, dict):
@@ -2248,37 +2707,28 @@ class GameService:
         except Exception:
             pass
 
-
-        cur = str(doc.get('current_turn') or ts.get('current_player') or 'sente')
-        move_hist = list(doc.get('move_history') or [])
+        move_hist = doc.get('move_history')
+        # Stored history is a list: only the new entry is $pushed below.
+        hist_stored = isinstance(move_hist, list)
+        if not hist_stored:
+            move_hist = []
         ply = len(move_hist) + 1
 
         
         if over > 0:
-            # 遅着猶予（config.py の TIMEOUT_GRACE_SECONDS * 1000ms）
-            grace_ms = 3000
-            try:
-                from ..config import TIMEOUT_GRACE_SECONDS
-                grace_ms = int(TIMEOUT_GRACE_SECONDS) * 1000
-            except Exception:
-                pass
-            # 対局ごと上書き: time_state.config.time_grace_ms（0で無効）
-            try:
-                gcfg = ts.get('config') or {}
-                if gcfg.get('time_grace_ms') is not None:
-                    grace_ms = int(gcfg.get('time_grace_ms') or 0)
-            except Exception:
-                pass
-        
+            # 遅着猶予（対局ごと上書き: time_state.config.time_grace_ms、0で無効）
+            grace_ms = _grace_ms_for(ts)
+
             if over <= grace_ms:
                 # グレース内 → タイムアウト扱いにしないで続行
                 pass
             else:
                 loser_role = cur
-                winner_role = 'gote' if cur == 'sente' else 'sente'
+                winner_role = _OPP[cur]
                 try:
+                    # doc の time_state は上で減算済みだが DB には書いていないので、doc は渡さず再読込させる
                     self.finish_game(
-                        game_id=str(game_id),
+                        game_id=gid,
                         winner_role=winner_role,
                         loser_role=loser_role,
                         reason='timeout',
@@ -2373,16 +2823,17 @@ class GameService:
             msg = (apply_res or {}).get('message') if isinstance(apply_res, dict) else None
             return {'success': False, 'message': (msg or 'illegal_move')}
 
+        board0, hands0 = board, hands
         board = apply_res['board']
         hands = apply_res['hands']
         move_rec = dict(apply_res.get('move_rec') or {})
-        move_rec['ts'] = self._now().isoformat()
+        move_rec['ts'] = now_iso
         move_rec['spent_ms'] = spent
         move_rec['ply'] = ply
 
 
         # Determine next turn (after this move)
-        next_turn = 'gote' if role == 'sente' else 'sente'
+        next_turn = _OPP[role]
 
         # Check flag: does this move give check to opponent?
         gives_check = False
@@ -2435,7 +2886,7 @@ class GameService:
             'usi': (final_usi or client_usi or None),
             'by': role,
             'spent_ms': int(spent) if spent is not None else 0,
-            'ts': str(move_rec.get('ts') or self._now().isoformat()),
+            'ts': move_rec.get('ts') or now_iso,
         }
 
         entry['check'] = bool(gives_check)
@@ -2451,151 +2902,157 @@ class GameService:
         new_sfen = _build_sfen(board, next_turn, hands, new_ply)
         if not new_sfen:
             return {'success': False, 'message': 'sfen_build_failed'}
-        old_sfen = doc.get('sfen')
         doc['sfen'] = new_sfen
-        doc['updated_at'] = self._now()
+        doc['updated_at'] = now_dt
         doc['time_state'] = ts
 
         # --- repetition (sennichite) tracking ---
         repetition_triggered = False
         rep_offender = None  # 'sente' or 'gote' when perpetual check
+        z_new = None  # hash of the new position, reused as the mate/nyugyoku memo key
+        rep_delta = None  # (new_key, new_idx) when only this occurrence needs writing
 
         try:
-            rep = doc.get('repetition') or {}
-            keys = list(rep.get('keys') or [])
-            counts = dict(rep.get('counts') or {})
-
-            cur_key = _normalize_sfen_key(old_sfen or '')
-            if cur_key:
-                if not keys:
-                    keys = [cur_key]
-                    counts[cur_key] = int(counts.get(cur_key) or 0) + 1 if counts else 1
-                else:
-                    # repair: ensure current position is represented as the latest key
-                    if str(keys[-1]) != str(cur_key):
-                        keys.append(cur_key)
-                        counts[cur_key] = int(counts.get(cur_key) or 0) + 1
+            new_idx = len(move_hist)
+            cur_idx = new_idx - 1
+            rep = _load_repetition(doc.get('repetition'), cur_idx)
+            counts = rep['counts']
+            last_indices = rep['last_indices']
+
+            # The last recorded key is the hash of the position before this move;
+            # otherwise (first move / legacy docs) hash the board once and record it.
+            if rep.get('last_key') and rep.get('last_index') == cur_idx:
+                h_cur = int(rep['last_key'], 16)
+                stored_rep = doc.get('repetition')
+                in_sync = isinstance(stored_rep, dict) and stored_rep.get('key') == _ZOBRIST_KEY_TYPE
+            else:
+                in_sync = False
+                h_cur = _zobrist_full(board0, hands0, role)
+                _record_repetition(rep, _zobrist_key(h_cur), cur_idx)
 
-            new_key = _normalize_sfen_key(new_sfen or '')
+            z_new = _zobrist_after_move(h_cur, board0, hands0, role, move_rec)
+            new_key = _zobrist_key(z_new)
             if new_key:
-                keys.append(new_key)
-                counts[new_key] = int(counts.get(new_key) or 0) + 1
+                _record_repetition(rep, new_key, new_idx)
+                if in_sync:
+                    rep_delta = (new_key, new_idx)
 
-                if int(counts.get(new_key) or 0) >= 4:
+                if counts[new_key] >= 4:
                     repetition_triggered = True
 
                     # perpetual check (連続王手) detection:
                     # examine moves from the earliest of the last 4 occurrences to now.
-                    pos_idx = [i for i, k in enumerate(keys) if str(k) == str(new_key)]
-                    if len(pos_idx) >= 4:
-                        i_start = int(pos_idx[-4])
-                        segment = list(move_hist[i_start:])  # move_hist[i] -> keys[i] => keys[i+1]
-                        sente_all = False
-                        gote_all = False
-                        s_moves = [m for m in segment if str(m.get('by')) == 'sente']
-                        g_moves = [m for m in segment if str(m.get('by')) == 'gote']
-                        if s_moves and all(bool(m.get('check')) for m in s_moves):
-                            sente_all = True
-                        if g_moves and all(bool(m.get('check')) for m in g_moves):
-                            gote_all = True
-                        if sente_all and not gote_all:
-                            rep_offender = 'sente'
-                        elif gote_all and not sente_all:
-                            rep_offender = 'gote'
+                    # move_hist[i] leads from position i to position i+1.
+                    occ = last_indices.get(new_key) or []
+                    if len(occ) >= 4:
+                        rep_offender = _perpetual_check_offender(move_hist, int(occ[-4]))
         except Exception:
             # keep moving even if repetition tracking fails
-            keys = None
-            counts = None
+            rep = None
 
-        if isinstance(keys, list) and isinstance(counts, dict):
-            doc['repetition'] = {'keys': keys, 'counts': counts}
+        if isinstance(rep, dict):
+            doc['repetition'] = rep
 
 
         upd = {
             'sfen': new_sfen,
-            'move_history': move_hist,
             'current_turn': next_turn,
             'updated_at': doc['updated_at'],
             'time_state': ts,
         }
-
-        if isinstance(doc.get('repetition'), dict):
+        push = {}
+        if hist_stored and self._delta_updates:
+            push['move_history'] = move_hist[-1]
+        else:
+            upd['move_history'] = move_hist
+
+        # Repetition: when the stored subdoc is already current, send only this
+        # occurrence ($inc / capped $push); otherwise (first move, legacy or
+        # converted docs, memory DB) write the whole subdoc.
+        rep_inc = None
+        if rep_delta is not None and self._delta_updates:
+            k, i = rep_delta
+            upd['repetition.last_key'] = k
+            upd['repetition.last_index'] = i
+            rep_inc = {f'repetition.counts.{k}': 1}
+            push[f'repetition.last_indices.{k}'] = {'$each': [i], '$slice': -_REPETITION_KEEP}
+        elif isinstance(doc.get('repetition'), dict):
             upd['repetition'] = doc.get('repetition')
-        self.game_model.update_one({"_id": game_id}, {"$set": upd, "$unset": {'board': '', 'captured': ''}})
 
+        # Terminal result of this move, if any: (winner, loser, reason, extra_set).
+        # Detected before writing so the move and the finish go out in one update.
+        terminal = None
 
         # If the move checkmates the opponent, end now (priority over repetition).
+        # gives_check is the same in-check test _is_checkmate starts with.
         try:
-            if _is_checkmate(board, hands, next_turn, depth=0):
-                winner_role = role
-                loser_role = next_turn
-                _finished, doc_end = self.finish_game(
-                    game_id=str(game_id),
-                    winner_role=winner_role,
-                    loser_role=loser_role,
-                    reason='checkmate',
-                    presence_mode='review',
-                    emit=True,
-                )
-                return dict(success=True, **self.as_api_payload(doc_end, me))
+            if gives_check and _is_checkmate(board, hands, next_turn, depth=0, zkey=z_new):
+                terminal = (role, next_turn, 'checkmate', None)
         except Exception:
             pass
 
         # If repetition reached 4th occurrence, auto-finish.
+        if terminal is None and repetition_triggered:
+            if rep_offender in ('sente', 'gote'):
+                # Perpetual check: offender loses
+                terminal = (_OPP[rep_offender], rep_offender, 'perpetual_check_sennichite', None)
+            else:
+                # Normal sennichite: draw
+                terminal = ('draw', 'draw', 'sennichite', None)
 
-        if repetition_triggered:
+        # --- nyugyoku / long-game (256 moves) ---
+        if terminal is None:
             try:
-                if rep_offender in ('sente', 'gote'):
-                    # Perpetual check: offender loses
-                    winner_role = self._opponent(rep_offender)
-                    loser_role = rep_offender
-                    _finished, doc_end = self.finish_game(
-                        game_id=str(game_id),
-                        winner_role=winner_role,
-                        loser_role=loser_role,
-                        reason='perpetual_check_sennichite',
-                        presence_mode='review',
-                        emit=True,
+                outcome = _evaluate_nyugyoku_outcome(board, hands, len(move_hist), zkey=z_new)
+                if isinstance(outcome, dict) and outcome.get('reason'):
+                    terminal = (
+                        str(outcome.get('winner_role')),
+                        str(outcome.get('loser_role')),
+                        str(outcome.get('reason')),
+                        (outcome.get('extra_set') if isinstance(outcome.get('extra_set'), dict) else None),
                     )
-                    return dict(success=True, **self.as_api_payload(doc_end, me))
-                else:
-                    # Normal sennichite: draw
-                    _finished, doc_end = self.finish_game(
-                        game_id=str(game_id),
-                        winner_role='draw',
-                        loser_role='draw',
-                        reason='sennichite',
-                        presence_mode='review',
-                        emit=True,
-                    )
-                    return dict(success=True, **self.as_api_payload(doc_end, me))
             except Exception:
                 pass
 
+        # _ensure_sfen_fields already dropped migrated legacy fields; only unset leftovers.
+        mongo_upd = {"$set": upd}
+        if rep_inc:
+            mongo_upd["$inc"] = rep_inc
+        if push:
+            mongo_upd["$push"] = push
+        if 'board' in doc or 'captured' in doc:
+            mongo_upd["$unset"] = {'board': '', 'captured': ''}
+
+        if terminal is None:
+            self.game_model.update_one({"_id": game_id}, mongo_upd)
+        else:
+            winner_role, loser_role, reason, extra_set = terminal
+            finish_set = self._compute_finish_set(winner_role, loser_role, reason, now_dt, extra_set)
+            upd.update(finish_set)
+            res = self.game_model.update_one(
+                {"_id": game_id, 'status': {'$ne': 'finished'}},
+                mongo_upd,
+            )
+            if getattr(res, 'modified_count', 1) == 0:
+                # finished concurrently (e.g. timeout): this move was not recorded
+                return {'success': False, 'message': 'already_finished'}
+            # doc already carries this move; apply the finish fields locally instead of re-reading.
+            doc.update(finish_set)
+            doc_end = self._after_finish(
+                gid, winner_role, loser_role, reason,
+                presence_mode='review',
+                emit=True,
+                doc=doc,
+            )
+            return dict(success=True, **self.as_api_payload(doc_end, me))
 
-        # --- nyugyoku / long-game (256 moves) ---
-        try:
-            outcome = _evaluate_nyugyoku_outcome(board, hands, len(move_hist))
-            if isinstance(outcome, dict) and outcome.get('reason'):
-                _finished, doc_end = self.finish_game(
-                    game_id=str(game_id),
-                    winner_role=str(outcome.get('winner_role')),
-                    loser_role=str(outcome.get('loser_role')),
-                    reason=str(outcome.get('reason')),
-                    presence_mode='review',
-                    extra_set=(outcome.get('extra_set') if isinstance(outcome.get('extra_set'), dict) else None),
-                    emit=True,
-                )
-                return dict(success=True, **self.as_api_payload(doc_end, me))
-        except Exception:
-            pass
-
-        return dict(success=True, **self.as_api_payload(doc, me))
+        state = {'board': board, 'hands': hands, 'turn': next_turn, 'ply': new_ply}
+        return dict(success=True, **self.as_api_payload(doc, me, state=state))
 
 
 
     def resign_game(self, game_id: str, me: str):
-        doc = self.game_model.find_one({"_id": game_id})
+        doc = self.game_model.find_one({"_id": game_id}, _NO_CHAT_PROJECTION)
         if not doc:
             return {'success': False, 'message': 'not_found'}
 
@@ -2603,7 +3060,7 @@ class GameService:
         if role is None:
             return {'success': False, 'message': 'forbidden'}
 
-        winner_role = self._opponent(role)
+        winner_role = _OPP[role]
         loser_role = role
 
         if str(doc.get('status')) == 'finished':
@@ -2616,6 +3073,7 @@ class GameService:
             reason='resign',
             presence_mode='review',
             emit=True,
+            doc=doc,
         )
         if not finished:
             return {'success': False, 'message': 'already_finished'}
@@ -2632,11 +3090,22 @@ class GameService:
         statuses = ['active', 'ongoing', 'in_progress', 'started']
         if include_waiting:
             statuses = ['waiting'] + statuses
-        cur = self.game_model.find({"status": {"$in": statuses}}).limit(int(limit))
+        coll = self.game_model
+        limit = int(limit)
+        match = {"status": {"$in": statuses}}
+        if hasattr(coll, 'aggregate'):
+            cur = coll.aggregate([
+                {"$match": match},
+                {"$sort": {"updated_at": -1}},
+                {"$limit": limit},
+                {"$project": _LOBBY_PROJECTION},
+            ])
+        else:
+            cur = coll.find(match, _LOBBY_PROJECTION).sort("updated_at", -1).limit(limit)
         out = []
         for doc in cur:
             try:
-                out.append(self.as_api_payload(doc))
+                out.append(self._shape_lobby_entry(doc))
             except Exception:
                 out.append({
                     "id": doc.get("_id"),
@@ -2644,16 +3113,29 @@ class GameService:
                     "current_turn": doc.get("current_turn"),
                     "updated_at": (doc.get("updated_at") or self._now()).isoformat(),
                 })
+        return out
+
+    def _shape_lobby_entry(self, doc: dict) -> dict:
+        """Lobby row from a projected game doc (no board / move_history / clock math)."""
+        ts = doc.get("time_state") or {}
+        players = {}
+        for role in ('sente', 'gote'):
+            p = (doc.get("players") or {}).get(role) or {}
+            players[role] = {"user_id": p.get("user_id"), "username": p.get("username")}
+        return _json_safe({
+            "id": doc.get("_id"),
+            "status": doc.get("status"),
+            "current_turn": doc.get("current_turn") or ts.get("current_player"),
+            "players": players,
+            "time_state": ts,
+            "time_config": ts.get("config") if isinstance(ts, dict) else None,
+            "updated_at": (doc.get("updated_at") or self._now()).isoformat(),
+        })
+
     # --- KIF helpers ---
     def _piece_kanji(self, piece: str) -> str:
-        mp = {
-            'pawn': '歩', 'lance': '香', 'knight': '桂', 'silver': '銀',
-            'gold': '金', 'bishop': '角', 'rook': '飛', 'king': '玉',
-            'promoted_pawn': 'と', 'promoted_lance': '成香', 'promoted_knight': '成桂',
-            'promoted_silver': '成銀', 'horse': '馬', 'dragon': '龍',
-            'promoted_bishop': '馬', 'promoted_rook': '龍',
-        }
-        return mp.get(str(piece), str(piece))
+        piece = str(piece)
+        return _PIECE_KANJI.get(piece, piece)
 
     def _to_kif(self, by: str, rec: dict) -> str:
         typ = rec.get('type')
@@ -2663,19 +3145,7 @@ class GameService:
         # 本システムでは、KIF出力時は手番(▲/△)を省略します。
         # 参考: https://kakinoki.o.oo7.jp/kif_format.html
 
-        raw_piece = rec.get('piece') or rec.get('piece_type') or ''
-
-        # 「成」のときは、駒名を成駒にせず「歩成」「角成」などの形にする。
-        promoted_to_base = {
-            'promoted_pawn': 'pawn',
-            'promoted_lance': 'lance',
-            'promoted_knight': 'knight',
-            'promoted_silver': 'silver',
-            'horse': 'bishop',
-            'dragon': 'rook',
-            'promoted_bishop': 'bishop',
-            'promoted_rook': 'rook',
-        }
+        raw_piece = str(rec.get('piece') or rec.get('piece_type') or '')
 
         is_promo_move = bool(
             rec.get('promote')
@@ -2684,18 +3154,16 @@ class GameService:
             or rec.get('is_promotion')
         )
 
-        disp_piece_key = promoted_to_base.get(str(raw_piece), str(raw_piece)) if is_promo_move else str(raw_piece)
-        piece = self._piece_kanji(disp_piece_key)
+        disp_piece_key = _PROMO_TO_BASE.get(raw_piece, raw_piece) if is_promo_move else raw_piece
+        piece = _PIECE_KANJI.get(disp_piece_key, disp_piece_key)
         to = rec.get('to') or {}
-        fr = rec.get('from') or {}
-        fw = '０１２３４５６７８９'
-        rows = ['','一','二','三','四','五','六','七','八','九']
         tc = 9 - int(to.get('c') or to.get('col') or to.get('x') or 0)
         tr = int(to.get('r') or to.get('row') or to.get('y') or 0) + 1
-        tc_fw = fw[tc] if 0 <= tc <= 9 else str(tc)
-        tr_kan = rows[tr] if 0 <= tr < len(rows) else str(tr)
+        tc_fw = _FW_DIGITS[tc] if 0 <= tc <= 9 else str(tc)
+        tr_kan = _ROW_KAN[tr] if 0 <= tr <= 9 else str(tr)
         if typ == 'drop':
             return f"{tc_fw}{tr_kan}{piece}打"
+        fr = rec.get('from') or {}
         fc = 9 - int(fr.get('c') or fr.get('col') or fr.get('x') or 0)
         frw= int(fr.get('r') or fr.get('row') or fr.get('y') or 0) + 1
         promo = '成' if is_promo_move else ''
@@ -2707,4 +3175,3 @@ class GameService:
             return self._to_kif(by, rec)
         except Exception:
             return None
-        return out
\ No newline at end of file
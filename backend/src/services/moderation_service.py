@@ -12,6 +12,9 @@ This file aims to be safe to import even when some optional modules are missing.
 
 from __future__ import annotations
 
+import functools
+import re
+import time
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Sequence
 
@@ -20,6 +23,54 @@ try:
 except Exception:  # pragma: no cover
     ObjectId = None  # type: ignore
 
+# How long scan_text reuses the warning-word list before re-reading it.
+# Edits made in this process invalidate immediately; the admin process's edits show up within this window.
+_WW_TTL = 5.0
+
+
+# Built-in warning templates (read-only; shown even when DB is empty).
+_DEFAULT_TEMPLATES = (
+    {
+        'name': 'チャットマナー',
+        'message': 'チャットの言葉遣い・表現が他者を不快にする可能性があります。以後ご注意ください。繰り返された場合、利用制限（BAN等）を行います。',
+    },
+    {
+        'name': '不適切ワード',
+        'message': '不適切な表現（警告ワード）を含むチャットが確認されました。以後送信しないでください。',
+    },
+    {
+        'name': '荒らし行為',
+        'message': '荒らし行為とみなされる行動が確認されました。今後同様の行為が続く場合、利用制限（BAN等）を行います。',
+    },
+    {
+        'name': 'スパム/宣伝',
+        'message': 'スパム・宣伝目的と思われる投稿が確認されました。以後同様の投稿は行わないでください。',
+    },
+    {
+        'name': '複数アカウント疑い',
+        'message': '複数アカウントの利用が疑われる状況が確認されました。心当たりがある場合は停止してください。改善がない場合、利用制限（BAN等）を行います。',
+    },
+)
+# (message_lc, list_warning_templates item) for the built-ins, built once.
+_DEFAULT_TEMPLATE_ENTRIES = tuple(
+    (t['message'].strip().lower(), {
+        'id': f'builtin-{i+1}',
+        'name': t['name'],
+        'message': t['message'],
+        'is_builtin': True,
+    })
+    for i, t in enumerate(_DEFAULT_TEMPLATES)
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _oid_from_str(s: str):
+    """ObjectId(s) or None; memoized since the same user ids recur across calls."""
+    try:
+        return ObjectId(s)
+    except Exception:
+        return None
+
 
 def _maybe_oid(v: Any):
     """Convert to ObjectId if possible. Returns original if not convertible."""
@@ -30,8 +81,8 @@ def _maybe_oid(v: Any):
     try:
         if isinstance(v, ObjectId):
             return v
-        s = str(v)
-        return ObjectId(s)
+        oid = _oid_from_str(str(v))
+        return v if oid is None else oid
     except Exception:
         return v
 
@@ -43,6 +94,10 @@ class ModerationService:
         self.games = self._get_coll('games')
         self.warning_words = self._get_coll('warning_words')
         self.warning_templates = self._get_coll('warning_templates')
+        # scan_text matcher: (entries, compiled alternation, utf-8 needles), rebuilt when the word list changes
+        self._ww_matcher: Optional[tuple] = None
+        # (monotonic ts, matcher) reused by scan_text for _WW_TTL seconds
+        self._ww_cache: Optional[tuple] = None
 
         # Best-effort indexes (Mongo only)
         try:
@@ -79,8 +134,8 @@ class ModerationService:
         # Mongo
         if hasattr(col, 'find'):
             try:
-                cur = col.find({}).sort([('word_lc', 1)])
-                return [dict(d) for d in cur]
+                # the driver already returns fresh dicts
+                return list(col.find({}).sort([('word_lc', 1)]))
             except Exception:
                 pass
         # Memory fallback
@@ -100,6 +155,7 @@ class ModerationService:
             return None
         lc = w.lower()
         now = datetime.utcnow()
+        self._ww_cache = None
 
         # de-dup
         try:
@@ -130,6 +186,7 @@ class ModerationService:
         if col is None:
             return False
         oid = _maybe_oid(word_id)
+        self._ww_cache = None
         # Try by _id (ObjectId), then by string.
         try:
             res = col.delete_one({'_id': oid})
@@ -156,86 +213,45 @@ class ModerationService:
     @staticmethod
     def default_warning_templates() -> List[Dict[str, str]]:
         """Built-in templates (shown even when DB is empty)."""
-        return [
-            {
-                'name': 'チャットマナー',
-                'message': 'チャットの言葉遣い・表現が他者を不快にする可能性があります。以後ご注意ください。繰り返された場合、利用制限（BAN等）を行います。',
-            },
-            {
-                'name': '不適切ワード',
-                'message': '不適切な表現（警告ワード）を含むチャットが確認されました。以後送信しないでください。',
-            },
-            {
-                'name': '荒らし行為',
-                'message': '荒らし行為とみなされる行動が確認されました。今後同様の行為が続く場合、利用制限（BAN等）を行います。',
-            },
-            {
-                'name': 'スパム/宣伝',
-                'message': 'スパム・宣伝目的と思われる投稿が確認されました。以後同様の投稿は行わないでください。',
-            },
-            {
-                'name': '複数アカウント疑い',
-                'message': '複数アカウントの利用が疑われる状況が確認されました。心当たりがある場合は停止してください。改善がない場合、利用制限（BAN等）を行います。',
-            },
-        ]
+        # copies: callers may edit the returned dicts
+        return [dict(t) for t in _DEFAULT_TEMPLATES]
 
     def list_warning_templates(self) -> List[Dict[str, Any]]:
         col = self.warning_templates
-        items: List[Dict[str, Any]] = []
+        # (message_lc, item) pairs from the DB
+        items: List[tuple] = []
+
+        def _db_item(d: Dict[str, Any]) -> tuple:
+            msg = (d.get('message') or '').strip()
+            return (d.get('message_lc') or msg.lower(), {
+                'id': str(d.get('_id')),
+                'name': (d.get('name') or '').strip() or 'テンプレート',
+                'message': msg,
+                'is_builtin': False,
+            })
 
         # DB templates
         if col is not None and hasattr(col, 'find'):
             try:
                 cur = col.find({}).sort([('created_at', -1)])
-                for d in cur:
-                    if not isinstance(d, dict):
-                        continue
-                    items.append({
-                        'id': str(d.get('_id')),
-                        'name': (d.get('name') or '').strip() or 'テンプレート',
-                        'message': (d.get('message') or '').strip(),
-                        'is_builtin': False,
-                    })
+                items = [_db_item(d) for d in cur if isinstance(d, dict)]
             except Exception:
                 items = []
         elif col is not None:
             try:
                 raw = list(getattr(col, '_b', {}).values())
-                for d in raw:
-                    if not isinstance(d, dict):
-                        continue
-                    items.append({
-                        'id': str(d.get('_id')),
-                        'name': (d.get('name') or '').strip() or 'テンプレート',
-                        'message': (d.get('message') or '').strip(),
-                        'is_builtin': False,
-                    })
+                items = [_db_item(d) for d in raw if isinstance(d, dict)]
             except Exception:
                 items = []
 
-        # Built-ins
-        builtins = [
-            {
-                'id': f'builtin-{i+1}',
-                'name': t.get('name', 'テンプレート'),
-                'message': t.get('message', ''),
-                'is_builtin': True,
-            }
-            for i, t in enumerate(self.default_warning_templates())
-        ]
-
-        # merge (dedupe by message)
-        merged: List[Dict[str, Any]] = []
-        seen = set()
-        for t in (builtins + items):
-            msg = (t.get('message') or '').strip()
-            key = msg.lower()
-            if not msg or key in seen:
-                continue
-            seen.add(key)
-            merged.append(t)
+        # merge (dedupe by message; built-ins first)
+        # built-ins are copied so edits to the returned items never reach the module constants
+        merged: Dict[str, Dict[str, Any]] = {k: dict(t) for k, t in _DEFAULT_TEMPLATE_ENTRIES}
+        for key, t in items:
+            if t['message'] and key not in merged:
+                merged[key] = t
 
-        return merged
+        return list(merged.values())
 
     def add_warning_template(self, name: str, message: str) -> Optional[str]:
         col = self.warning_templates
@@ -298,46 +314,86 @@ class ModerationService:
         return False
 
     # --- scanning ------------------------------------------------------
-    def scan_text(self, text: str) -> List[str]:
-        """Return matched warning words.
+    def _warning_matcher(self, words: List[Dict[str, Any]]) -> tuple:
+        """Return ((word, word_lc), ...), a compiled alternation of all word_lc and
+        ((word, word_lc as UTF-8), ...) for the exact check.
 
-        Matching policy: case-insensitive substring.
+        Cached on the instance and rebuilt only when the word list differs.
         """
-        s = (text or '').strip()
-        if not s:
-            return []
-        s_lc = s.lower()
-        words = self.list_warning_words()
-        hits: List[str] = []
+        entries = []
         for d in words:
             w = (d.get('word') or '').strip()
             if not w:
                 continue
-            if (d.get('word_lc') or str(w).lower()) in s_lc:
-                hits.append(w)
+            entries.append((w, d.get('word_lc') or w.lower()))
+        entries = tuple(entries)
+
+        cached = self._ww_matcher
+        if cached is not None and cached[0] == entries:
+            return cached
+
+        # Longest first so the alternation prefers full words; it is only a prefilter.
+        alts = sorted({lc for _, lc in entries}, key=len, reverse=True)
+        pattern = re.compile('|'.join(map(re.escape, alts))) if alts else None
+        needles = tuple((w, lc.encode('utf-8')) for w, lc in entries)
+        self._ww_matcher = (entries, pattern, needles)
+        return self._ww_matcher
+
+    def scan_text(self, text: str) -> List[str]:
+        """Return matched warning words.
+
+        Matching policy: case-insensitive substring.
+        """
+        if not text:
+            return []
+        now = time.monotonic()
+        cached = self._ww_cache
+        if cached is not None and now - cached[0] < _WW_TTL:
+            _, pattern, needles = cached[1]
+        else:
+            matcher = self._warning_matcher(self.list_warning_words())
+            self._ww_cache = (now, matcher)
+            _, pattern, needles = matcher
+        # No warning words configured: nothing to normalize or scan.
+        if pattern is None:
+            return []
+        s_lc = text.strip().lower()
+        # One pass over the message for the common (clean) case; overlapping words
+        # are then resolved exactly by the per-word check.
+        if not s_lc or pattern.search(s_lc) is None:
+            return []
+        s_b = s_lc.encode('utf-8')
         # unique keep order
-        out: List[str] = []
-        seen = set()
-        for w in hits:
-            if w in seen:
-                continue
-            seen.add(w)
-            out.append(w)
-        return out
+        return list(dict.fromkeys(w for w, nb in needles if nb in s_b))
 
     # --- user flags / actions -----------------------------------------
-    def is_banned(self, user_id: Any) -> bool:
+    def _find_user(self, user_id: Any, projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Find a user stored under either the ObjectId or the string form of user_id.
+
+        Mongo: one query with $in over both forms. Memory DB (no $in): one lookup per form.
+        """
         col = self.users
         if col is None:
-            return False
-        oid = _maybe_oid(user_id)
-        try:
-            u = col.find_one({'_id': oid}, {'is_banned': 1})
-        except Exception:
+            return None
+        ids = [_maybe_oid(user_id), str(user_id)]
+        if ids[0] == ids[1]:
+            ids.pop()
+        if hasattr(col, 'find'):
             try:
-                u = col.find_one({'_id': str(user_id)}, {'is_banned': 1})
+                return col.find_one({'_id': {'$in': ids}}, projection)
+            except Exception:
+                return None
+        for _id in ids:
+            try:
+                u = col.find_one({'_id': _id})
             except Exception:
                 u = None
+            if u:
+                return u
+        return None
+
+    def is_banned(self, user_id: Any) -> bool:
+        u = self._find_user(user_id, {'is_banned': 1})
         return bool((u or {}).get('is_banned'))
 
     def set_banned(self, user_id: Any, banned: bool) -> bool:
@@ -376,29 +432,22 @@ class ModerationService:
         msg = (message or '').strip() or '運営からの警告です。利用規約をご確認ください。'
         oid = _maybe_oid(user_id)
 
-        try:
-            u = col.find_one({'_id': oid}) or {}
-        except Exception:
-            try:
-                u = col.find_one({'_id': str(user_id)}) or {}
-            except Exception:
-                u = {}
-        cur = int(u.get('warning_count') or 0)
-        new_count = cur + 1
-
-        patch = {
-            'warning_count': new_count,
-            'login_warning_pending': True,
-            'login_warning_message': msg,
-            'last_warned_at': datetime.utcnow(),
+        # Single atomic write: concurrent warns both count.
+        upd = {
+            '$set': {
+                'login_warning_pending': True,
+                'login_warning_message': msg,
+                'last_warned_at': datetime.utcnow(),
+            },
+            '$inc': {'warning_count': 1},
         }
 
         try:
-            col.update_one({'_id': oid}, {'$set': patch})
+            col.update_one({'_id': oid}, upd)
             return True
         except Exception:
             try:
-                col.update_one({'_id': str(user_id)}, {'$set': patch})
+                col.update_one({'_id': str(user_id)}, upd)
                 return True
             except Exception:
                 return False
@@ -477,7 +526,7 @@ class ModerationService:
             try:
                 cur = col.find({}, fields)
                 # primary sort in python to keep behavior stable even when field missing
-                items = [dict(d) for d in cur]
+                items = list(cur)
             except Exception:
                 items = []
         else:
@@ -16,46 +16,82 @@ from __future__ import annotations
 
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 import logging
+import threading
 from datetime import datetime, date
 
 from flask import current_app
 
+try:
+    from bson import ObjectId as _OID
+except Exception:  # pragma: no cover
+    _OID = None
+
 logger = logging.getLogger(__name__)
 
 # Match what the UI considers "in game" for a spectate/join button.
-_ACTIVE_GAME_STATUSES = [
+_ACTIVE_GAME_STATUSES = (
     'active', 'ongoing', 'in_progress', 'started', 'pause', 'review'
-]
+)
+_STATUS_FILTER = {'status': {'$in': _ACTIVE_GAME_STATUSES}}
+
+# Fields read by _extract_profile_fields / the patch builder.
+_PROFILE_PROJECTION = {
+    'username': 1, 'name': 1, 'rating': 1, 'rate': 1,
+    'user_kind': 1, 'legion': 1, 'is_guest': 1,
+}
+# Only the player ids of a game (not the whole players subtree).
+_GAME_PLAYER_PROJECTION = {
+    'players.sente.user_id': 1, 'players.gote.user_id': 1, 'sente_id': 1, 'gote_id': 1,
+}
+_PRESENCE_PROJECTION = {'user_id': 1, 'waiting': 1, 'waiting_info': 1, 'pending_offer': 1}
+
+
+# id(app) -> resolved SocketIO instance
+_sio_cache: Dict[int, Any] = {}
 
 
 def _get_socketio_fallback():
     """Resolve SocketIO instance from current_app.
 
     We prefer `current_app.extensions['socketio']` because this project stores
-    it there.
+    it there. The result is memoized per app object.
     """
     try:
-        ex = getattr(current_app, 'extensions', None) or {}
-        sio = ex.get('socketio')
-        if sio:
-            return sio
+        app = current_app._get_current_object()
     except Exception:
-        pass
+        return None
+    sio = _sio_cache.get(id(app))
+    if sio:
+        return sio
     try:
-        sio = current_app.config.get('SOCKETIO')
-        if sio:
-            return sio
+        ex = getattr(app, 'extensions', None) or {}
+        sio = ex.get('socketio')
     except Exception:
-        pass
+        sio = None
+    if not sio:
+        try:
+            sio = app.config.get('SOCKETIO')
+        except Exception:
+            sio = None
+    if sio:
+        _sio_cache[id(app)] = sio
+        return sio
     return None
 
 
-def _oid_helpers():
+def _batched(cursor, n: int):
+    """Apply cursor.batch_size(n) when supported (memory collections return lists)."""
     try:
-        from bson import ObjectId
-        return ObjectId
+        bs = getattr(cursor, 'batch_size', None)
+        if callable(bs):
+            return bs(int(n))
     except Exception:
-        return None
+        pass
+    return cursor
+
+
+def _oid_helpers():
+    return _OID
 
 
 def _to_oid(v) -> Optional[Any]:
@@ -99,30 +135,36 @@ def _id_to_str(v) -> str:
 
 
 
+_FLAT_SAFE_TYPES = (str, int, float, bool, type(None))
+
+
+def _is_json_safe_flat(d: Dict[Any, Any]) -> bool:
+    """True if d has only str keys and primitive values (nothing for _json_safe to convert)."""
+    for k, v in d.items():
+        if type(k) is not str or not isinstance(v, _FLAT_SAFE_TYPES):
+            return False
+    return True
+
+
 def _json_safe(x: Any):
     """Recursively convert values to JSON-serializable ones.
 
     Socket.IO JSON encoding cannot handle ObjectId/datetime/set/etc.
     """
-    try:
-        from bson import ObjectId as _OID
-    except Exception:
-        _OID = None
-
-    def conv(v):
+    def conv(v, _oid=_OID, _dt=datetime, _date=date):
         if v is None:
             return None
         try:
-            if _OID is not None and isinstance(v, _OID):
+            if _oid is not None and isinstance(v, _oid):
                 return str(v)
         except Exception:
             pass
-        if isinstance(v, (datetime,)):
+        if isinstance(v, _dt):
             try:
                 return v.isoformat().replace('+00:00', 'Z')
             except Exception:
                 return str(v)
-        if isinstance(v, (date,)) and not isinstance(v, datetime):
+        if isinstance(v, _date):
             try:
                 return v.isoformat()
             except Exception:
@@ -138,18 +180,23 @@ def _json_safe(x: Any):
         except Exception:
             return None
 
+    if isinstance(x, dict) and _is_json_safe_flat(x):
+        return x
     return conv(x)
 
 def _normalize_rating_range(v) -> Optional[int]:
     """Allowed: 100..400 step 50; None means no limit."""
     if v is None:
         return None
-    if isinstance(v, str) and v.strip() == '':
-        return None
-    try:
-        n = int(v)
-    except Exception:
-        return None
+    if type(v) is int:
+        n = v
+    else:
+        if isinstance(v, str) and (not v or len(v) > 32 or v.strip() == ''):
+            return None
+        try:
+            n = int(v)
+        except Exception:
+            return None
     if n < 100 or n > 400:
         return None
     if n % 50 != 0:
@@ -174,7 +221,9 @@ def _extract_profile_fields(prof: Dict[str, Any]) -> Tuple[str, int, str, str, b
 
     legion = prof.get('legion')
     if isinstance(legion, str):
-        legion = legion.strip().upper()
+        # stored values are usually already a short upper-case code ("JP")
+        if not (len(legion) <= 3 and legion.isalpha() and legion.isupper()):
+            legion = legion.strip().upper()
     else:
         legion = ''
     if not legion:
@@ -184,6 +233,40 @@ def _extract_profile_fields(prof: Dict[str, Any]) -> Tuple[str, int, str, str, b
     return str(username), int(rating), str(user_kind), str(legion), is_guest
 
 
+def _game_player_ids(g: Dict[str, Any]) -> Tuple[str, str, str]:
+    """(game_id, sente uid, gote uid) as strings from a games doc."""
+    def _uid(v):
+        return _id_to_str(v.get('user_id') if isinstance(v, dict) else v)
+
+    players = g.get('players') or {}
+    s_uid = _uid((players.get('sente') or {}).get('user_id')) or _id_to_str(g.get('sente_id'))
+    g_uid = _uid((players.get('gote') or {}).get('user_id')) or _id_to_str(g.get('gote_id'))
+    return _id_to_str(g.get('_id')), s_uid, g_uid
+
+
+_GAME_INDEX_READY = False
+
+
+def _ensure_game_indexes(games) -> None:
+    """Best-effort (once per process) indexes for the active-game lookup.
+
+    Each $or branch of _build_current_game_map gets a {status, <player id>} index so
+    the query is answered from indexes instead of a collection scan. These fields
+    are not touched by per-move updates, so the write cost is negligible.
+    """
+    global _GAME_INDEX_READY
+    if _GAME_INDEX_READY:
+        return
+    _GAME_INDEX_READY = True
+    if not hasattr(games, 'create_index'):
+        return
+    try:
+        for field in ('players.sente.user_id', 'players.gote.user_id', 'sente_id', 'gote_id'):
+            games.create_index([('status', 1), (field, 1)], name=f'status_{field.replace(".", "_")}')
+    except Exception:
+        pass
+
+
 def _build_current_game_map(db, user_oid_list: List[Any], user_str_list: List[str]) -> Dict[str, str]:
     """user_id(str) -> game_id(str) for active/review games."""
     game_map: Dict[str, str] = {}
@@ -205,23 +288,18 @@ def _build_current_game_map(db, user_oid_list: List[Any], user_str_list: List[st
     if not ors:
         return game_map
 
+    _ensure_game_indexes(games)
     try:
-        cursor = games.find(
-            {'status': {'$in': _ACTIVE_GAME_STATUSES}, '$or': ors},
-            {'players': 1, 'sente_id': 1, 'gote_id': 1}
-        )
+        cursor = _batched(games.find(
+            {**_STATUS_FILTER, '$or': ors},
+            _GAME_PLAYER_PROJECTION,
+        ), 256)
     except Exception:
         return game_map
 
-    def _uid(v):
-        return _id_to_str(v.get('user_id') if isinstance(v, dict) else v)
-
     try:
         for g in cursor:
-            gid = _id_to_str(g.get('_id'))
-            players = g.get('players') or {}
-            s_uid = _uid((players.get('sente') or {}).get('user_id')) or _id_to_str(g.get('sente_id'))
-            g_uid = _uid((players.get('gote') or {}).get('user_id')) or _id_to_str(g.get('gote_id'))
+            gid, s_uid, g_uid = _game_player_ids(g)
             if s_uid:
                 game_map[s_uid] = gid
             if g_uid:
@@ -232,6 +310,82 @@ def _build_current_game_map(db, user_oid_list: List[Any], user_str_list: List[st
     return game_map
 
 
+def _build_patch(pres: Dict[str, Any], prof: Dict[str, Any], uid_str: str, current_game_id: Optional[str]) -> Dict[str, Any]:
+    """One online_users_update patch from a presence doc and the user's profile."""
+    username, rating, user_kind, legion, is_guest = _extract_profile_fields(prof)
+
+    wi = pres.get('waiting_info') if isinstance(pres.get('waiting_info'), dict) else {}
+    wi = dict(wi or {})
+
+    # Keep wi aligned with profile.
+    try:
+        wi['username'] = username
+        wi['rating'] = rating
+        wi['user_kind'] = user_kind
+        wi['legion'] = legion
+        rr = _normalize_rating_range(wi.get('rating_range'))
+        if rr is not None:
+            wi['rating_range'] = rr
+            wi['rating_min'] = int(rating) - int(rr)
+            wi['rating_max'] = int(rating) + int(rr)
+    except Exception:
+        pass
+
+    pending_offer = pres.get('pending_offer') if isinstance(pres.get('pending_offer'), dict) else (pres.get('pending_offer') or {})
+
+    # Ensure JSON-safe nested values
+    try:
+        wi = _json_safe(wi) if isinstance(wi, dict) else {}
+        pending_offer = _json_safe(pending_offer) if isinstance(pending_offer, dict) else {}
+    except Exception:
+        wi = {}
+        pending_offer = {}
+
+    return {
+        'user_id': uid_str,
+        'current_game_id': current_game_id,
+        'username': username,
+        'rating': rating,
+        'user_kind': user_kind,
+        'legion': legion,
+        'is_guest': is_guest,
+        'waiting': pres.get('waiting', 'lobby') or 'lobby',
+        'waiting_info': wi,
+        'pending_offer': pending_offer,
+    }
+
+
+def _aggregate_presence(ou, q_or: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+    """Presence docs joined with their profile (`_prof`).
+
+    Active games are not joined here: a per-presence `$expr` lookup cannot use the
+    {status, <player id>} indexes, so they stay on the indexed `$in` query of
+    _build_current_game_map. Returns None when aggregation is not available
+    (memory DB) or fails, so the caller falls back to separate queries.
+    """
+    if not hasattr(ou, 'aggregate'):
+        return None
+    pipeline = [
+        {'$match': {'$or': q_or}},
+        {'$project': _PRESENCE_PROJECTION},
+        {'$lookup': {
+            'from': 'users',
+            # user_id may be stored as ObjectId or its hex string
+            'let': {'uo': {'$convert': {'input': '$user_id', 'to': 'objectId', 'onError': None, 'onNull': None}}},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$_id', '$$uo']}}},
+                {'$project': _PROFILE_PROJECTION},
+            ],
+            'as': '_prof',
+        }},
+    ]
+    try:
+        return list(ou.aggregate(pipeline))
+    except Exception:
+        logger.debug('online users $lookup aggregation failed; using separate queries', exc_info=True)
+        return None
+
+
 def build_online_user_patches(db, user_ids: Iterable[Any]) -> List[Dict[str, Any]]:
     """Build patch objects for the given user ids."""
     user_ids = list(user_ids or [])
@@ -240,7 +394,19 @@ def build_online_user_patches(db, user_ids: Iterable[Any]) -> List[Dict[str, Any
 
     oids: List[Any] = []
     strs: List[str] = []
+    is_valid = getattr(_OID, 'is_valid', None)
     for uid in user_ids:
+        # fast paths: ids are almost always an ObjectId or its 24-hex string
+        if _OID is not None and isinstance(uid, _OID):
+            oids.append(uid)
+            strs.append(str(uid))
+            continue
+        if type(uid) is str:
+            if uid:
+                strs.append(uid)
+                if is_valid is not None and len(uid) == 24 and is_valid(uid):
+                    oids.append(_OID(uid))
+            continue
         s = _id_to_str(uid)
         if s:
             strs.append(s)
@@ -262,8 +428,19 @@ def build_online_user_patches(db, user_ids: Iterable[Any]) -> List[Dict[str, Any
     if not q_or:
         return []
 
+    lookup = _aggregate_presence(ou, q_or)
+    if lookup is not None:
+        game_map = _build_current_game_map(db, oids, strs)
+        patches: List[Dict[str, Any]] = []
+        for pres in lookup:
+            uid_str = _id_to_str(pres.get('user_id') or pres.get('_id'))
+            profs = pres.get('_prof') or []
+            patches.append(_build_patch(pres, profs[0] if profs else {}, uid_str, game_map.get(uid_str)))
+        return patches
+
     try:
-        pres_docs = list(ou.find({'$or': q_or}))
+        # Up to two presence docs per id (ObjectId / str forms): fetch in one batch.
+        pres_docs = list(_batched(ou.find({'$or': q_or}, _PRESENCE_PROJECTION), max(len(user_ids) * 2, 128)))
     except Exception:
         pres_docs = []
 
@@ -272,62 +449,97 @@ def build_online_user_patches(db, user_ids: Iterable[Any]) -> List[Dict[str, Any
     try:
         users = db.get('users') if hasattr(db, 'get') else db['users']
         if oids:
-            for d in users.find({'_id': {'$in': oids}}):
+            for d in users.find({'_id': {'$in': oids}}, _PROFILE_PROJECTION):
                 profiles[_id_to_str(d.get('_id'))] = d
     except Exception:
         pass
 
     game_map = _build_current_game_map(db, oids, strs)
 
-    patches: List[Dict[str, Any]] = []
+    patches = []
     for pres in pres_docs:
         uid = pres.get('user_id') or pres.get('_id')
         uid_str = _id_to_str(uid)
-        prof = profiles.get(uid_str) or {}
+        patches.append(_build_patch(pres, profiles.get(uid_str) or {}, uid_str, game_map.get(uid_str)))
 
-        username, rating, user_kind, legion, is_guest = _extract_profile_fields(prof)
+    return patches
 
-        wi = pres.get('waiting_info') if isinstance(pres.get('waiting_info'), dict) else {}
-        wi = dict(wi or {})
 
-        # Keep wi aligned with profile.
-        try:
-            wi['username'] = username
-            wi['rating'] = rating
-            wi['user_kind'] = user_kind
-            wi['legion'] = legion
-            rr = _normalize_rating_range(wi.get('rating_range'))
-            if rr is not None:
-                wi['rating_range'] = rr
-                wi['rating_min'] = int(rating) - int(rr)
-                wi['rating_max'] = int(rating) + int(rr)
-        except Exception:
-            pass
+# 連続した diff emit を room 単位でまとめる（debounce）。
+# 窓が開いていなければ即 emit して窓を開き、窓の間に来た分だけを窓の終わりにまとめて emit する
+# （単発の入退室は遅延なし、連続した更新も最大 _DEBOUNCE_SEC の遅れで1回にまとまる）
+_DEBOUNCE_SEC = 0.075
+_pending: Dict[str, Dict[str, Any]] = {}
+_pending_lock = threading.Lock()
 
-        pending_offer = pres.get('pending_offer') if isinstance(pres.get('pending_offer'), dict) else (pres.get('pending_offer') or {})
 
-        # Ensure JSON-safe nested values
+def _emit_diff_now(db, sio, changed: List[Any], removed: List[Any], room: str) -> bool:
+    """Build patches for `changed` and emit one diff payload to `room`."""
+    patches = []
+    if changed and db is not None:
         try:
-            wi = _json_safe(wi) if isinstance(wi, dict) else {}
-            pending_offer = _json_safe(pending_offer) if isinstance(pending_offer, dict) else {}
+            patches = build_online_user_patches(db, changed)
         except Exception:
-            wi = {}
-            pending_offer = {}
-
-        patches.append({
-            'user_id': uid_str,
-            'current_game_id': game_map.get(uid_str),
-            'username': username,
-            'rating': rating,
-            'user_kind': user_kind,
-            'legion': legion,
-            'is_guest': is_guest,
-            'waiting': pres.get('waiting', 'lobby') or 'lobby',
-            'waiting_info': wi,
-            'pending_offer': pending_offer,
-        })
+            logger.warning('build_online_user_patches failed', exc_info=True)
+            patches = []
+        if changed and not patches:
+            logger.warning('emit_online_users_diff: changed=%s but produced 0 patches', [ _id_to_str(x) for x in changed ])
 
-    return patches
+    removed_strs = [_id_to_str(x) for x in removed if _id_to_str(x)]
+
+    if not patches and not removed_strs:
+        return False
+
+    payload = {
+        'type': 'diff',
+        'patches': patches,
+        'removed_user_ids': removed_strs,
+    }
+
+    try:
+        sio.emit('online_users_update', payload, room=room)
+        return True
+    except Exception as e:
+        logger.warning('emit_online_users_diff failed: %s', e, exc_info=True)
+        return False
+
+
+def _flush_pending(sio, room: str) -> None:
+    """Background task: wait one debounce window, then emit the diffs merged during it (if any)."""
+    try:
+        sio.sleep(_DEBOUNCE_SEC)
+    except Exception:
+        pass
+    with _pending_lock:
+        entry = _pending.pop(room, None)
+    if not entry:
+        return
+    _emit_diff_now(
+        entry['db'],
+        entry['sio'],
+        list(entry['changed'].values()),
+        list(entry['removed'].values()),
+        room,
+    )
+
+
+def _merge_pending(entry: Dict[str, Any], db, changed: List[Any], removed: List[Any]) -> None:
+    """Merge one diff into a pending window entry (caller holds _pending_lock).
+
+    The later state wins: changed -> removed / removed -> changed overwrite each other.
+    """
+    for x in changed:
+        k = _id_to_str(x)
+        if k:
+            entry['removed'].pop(k, None)
+            entry['changed'][k] = x
+    for x in removed:
+        k = _id_to_str(x)
+        if k:
+            entry['changed'].pop(k, None)
+            entry['removed'][k] = x
+    if db is not None:
+        entry['db'] = db
 
 
 def emit_online_users_diff(
@@ -340,7 +552,10 @@ def emit_online_users_diff(
 ) -> bool:
     """Emit diff payload to lobby.
 
-    Returns True if an emit was attempted.
+    The first call for a room is emitted immediately and opens a `_DEBOUNCE_SEC`
+    window; calls arriving within that window are merged and emitted once from
+    a background task when it closes.
+    Returns True if an emit was attempted (or queued).
     """
     try:
         changed = list(changed_user_ids or [])
@@ -348,19 +563,7 @@ def emit_online_users_diff(
     except Exception:
         changed, removed = [], []
 
-    patches = []
-    if changed and db is not None:
-        try:
-            patches = build_online_user_patches(db, changed)
-        except Exception:
-            logger.warning('build_online_user_patches failed', exc_info=True)
-            patches = []
-        if changed and not patches:
-            logger.warning('emit_online_users_diff: changed=%s but produced 0 patches', [ _id_to_str(x) for x in changed ])
-
-    removed_strs = [_id_to_str(x) for x in removed if _id_to_str(x)]
-
-    if not patches and not removed_strs:
+    if not changed and not removed:
         return False
 
     sio = socketio or _get_socketio_fallback()
@@ -368,15 +571,43 @@ def emit_online_users_diff(
         logger.warning('socketio not available: online_users_update diff skipped')
         return False
 
-    payload = {
-        'type': 'diff',
-        'patches': patches,
-        'removed_user_ids': removed_strs,
-    }
-
-    try:
-        sio.emit('online_users_update', payload, room=room)
-        return True
-    except Exception as e:
-        logger.warning('emit_online_users_diff failed: %s', e, exc_info=True)
-        return False
+    start = getattr(sio, 'start_background_task', None)
+    if _DEBOUNCE_SEC <= 0 or start is None:
+        return _emit_diff_now(db, sio, changed, removed, room)
+
+    # 窓が開いていなければ、窓を開いてこの diff はすぐ emit する。
+    with _pending_lock:
+        entry = _pending.get(room)
+        is_new = entry is None
+        if is_new:
+            _pending[room] = {'db': db, 'sio': sio, 'changed': {}, 'removed': {}}
+    if is_new:
+        ok = _emit_diff_now(db, sio, changed, removed, room)
+        # 窓は leading emit の後から数える（後続分が先に届いて状態が巻き戻らないように）
+        try:
+            start(_flush_pending, sio, room)
+        except Exception:
+            logger.warning('online_users_update flusher start failed; emitting inline', exc_info=True)
+            with _pending_lock:
+                entry = _pending.pop(room, None)
+            if entry and (entry['changed'] or entry['removed']):
+                _emit_diff_now(
+                    entry['db'],
+                    sio,
+                    list(entry['changed'].values()),
+                    list(entry['removed'].values()),
+                    room,
+                )
+        return ok
+
+    # 窓の間に来た diff はまとめ、flush で1回だけ emit する。
+    with _pending_lock:
+        entry = _pending.get(room)
+        if entry is not None:
+            _merge_pending(entry, db, changed, removed)
+    if entry is None:
+        # 直前に窓が閉じた: 次の窓の先頭として扱う
+        return emit_online_users_diff(
+            db, sio, changed_user_ids=changed, removed_user_ids=removed, room=room,
+        )
+    return True
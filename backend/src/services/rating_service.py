@@ -12,10 +12,15 @@
 """
 
 from __future__ import annotations
+import bisect
+import heapq
 import math
+import operator
+from dataclasses import dataclass
 from typing import Dict, Any, Optional, Tuple
 
 from src.models.database import DatabaseManager
+from src.services.sc24_rating import should_skip_rating
 try:
     from src.config import RATING_SYSTEMS, DEFAULT_RATING_SYSTEM
 except Exception:
@@ -36,6 +41,91 @@ except Exception:
     DEFAULT_RATING_SYSTEM = "legacy"
 
 
+# 10 ** (d / 400) == exp(d * ln(10) / 400)
+_LN10_DIV_400 = 2.302585092994046 / 400.0
+
+
+def _expected_raw(ra: float, rb: float) -> float:
+    # Elo 期待値
+    try:
+        return 1.0 / (1.0 + math.exp(_LN10_DIV_400 * (rb - ra)))
+    except Exception:
+        # 極端な差など数値例外時の安全弁
+        if ra > rb:
+            return 0.99
+        return 0.01
+
+
+# 整数レート差 d = rb - ra（|d| <= 800）の期待値表。_EXPECTED_TABLE[d + 800]
+# 値は _expected_raw と同じ式で作るのでビット単位で一致する。範囲外はその都度計算
+_EXPECTED_SPAN = 800
+_EXPECTED_TABLE = tuple(_expected_raw(0, d) for d in range(-_EXPECTED_SPAN, _EXPECTED_SPAN + 1))
+
+
+@dataclass(frozen=True)
+class _SystemCfg:
+    """RATING_SYSTEMS の1プロファイルを計算用に固定したもの（dict.get を毎回引かない）"""
+    k_base: float
+    provisional_games: int
+    min_rating: float
+    max_rating: Optional[float]   # None は上限なし
+    k_bands: Tuple[Tuple[Optional[float], Optional[float], float], ...]  # (lt, ge, k) を定義順に
+    draw_factor: float
+    skip_large_gaps: bool
+    # k_bands を lt / ge 別に閾値昇順で持つ（bisect 用）。昇順でない設定は None で線形走査
+    lt_bisect: Optional[Tuple[Tuple[float, ...], Tuple[float, ...]]] = None
+    ge_bisect: Optional[Tuple[Tuple[float, ...], Tuple[float, ...]]] = None
+
+    @classmethod
+    def from_dict(cls, key: str, d: Dict[str, Any]) -> "_SystemCfg":
+        max_r = d.get("max_rating", None)
+        bands = tuple(
+            (band.get("lt"), band.get("ge"), float(band["k"]))
+            for band in d.get("k_bands", [])
+        )
+        lt = [(b[0], b[2]) for b in bands if b[0] is not None]
+        ge = [(b[1], b[2]) for b in bands if b[1] is not None]
+        # 定義順で閾値が昇順なら「最初に当たる lt」「最後に当たる ge」は bisect で一意に求まる
+        bisectable = all(x[0] <= y[0] for x, y in zip(lt, lt[1:])) and all(x[0] <= y[0] for x, y in zip(ge, ge[1:]))
+        return cls(
+            k_base=float(d.get("k_base", 32)),
+            provisional_games=int(d.get("provisional_games", 0)),
+            min_rating=d.get("min_rating", 0) or 0,
+            max_rating=max_r if isinstance(max_r, (int, float)) else None,
+            k_bands=bands,
+            draw_factor=float(d.get("draw_factor", 0.5)),
+            skip_large_gaps=bool(d.get("skip_large_gaps", key == "sc24")),
+            lt_bisect=(tuple(t for t, _ in lt), tuple(k for _, k in lt)) if bisectable else None,
+            ge_bisect=(tuple(t for t, _ in ge), tuple(k for _, k in ge)) if bisectable else None,
+        )
+
+
+# 設定は import 時に固定（RatingService はインスタンス毎に作り直さずこれを引く）
+_SYSTEM_CFGS: Dict[str, _SystemCfg] = {k: _SystemCfg.from_dict(k, d) for k, d in RATING_SYSTEMS.items()}
+_DEFAULT_CFG: _SystemCfg = _SYSTEM_CFGS[DEFAULT_RATING_SYSTEM]
+
+
+# レーティング区分: _CLASS_THRESHOLDS[i-1] <= rating < _CLASS_THRESHOLDS[i] が _RATING_CLASSES[i]
+_CLASS_THRESHOLDS = (200, 400, 600, 800, 1000, 1200, 1400, 1600, 1800, 2000, 2200, 2400, 2600, 2800)
+_RATING_CLASSES = (
+    {'name': '4級', 'color': '#FFC107'},
+    {'name': '3級', 'color': '#CDDC39'},
+    {'name': '2級', 'color': '#8BC34A'},
+    {'name': '1級', 'color': '#4CAF50'},
+    {'name': '初段', 'color': '#009688'},
+    {'name': '二段', 'color': '#00BCD4'},
+    {'name': '三段', 'color': '#03A9F4'},
+    {'name': '四段', 'color': '#2196F3'},
+    {'name': '五段', 'color': '#3F51B5'},
+    {'name': '六段', 'color': '#673AB7'},
+    {'name': '七段', 'color': '#9C27B0'},
+    {'name': '八段', 'color': '#E91E63'},
+    {'name': '九段', 'color': '#FF1744'},
+    {'name': '名人', 'color': '#FF6B35'},
+    {'name': '竜王', 'color': '#FFD700'},
+)
+
+
 class RatingService:
     """レーティング管理サービス"""
 
@@ -57,43 +147,44 @@ class RatingService:
 
     # ================= 内部ユーティリティ =================
 
-    def _pick_cfg(self, system_key: Optional[str]) -> Dict[str, Any]:
-        key = system_key or self.default_system
-        return self.systems.get(key, self.systems[self.default_system])
+    def _pick_cfg(self, system_key: Optional[str]) -> _SystemCfg:
+        return _SYSTEM_CFGS.get(system_key, _DEFAULT_CFG) if system_key else _DEFAULT_CFG
 
     def _expected(self, ra: float, rb: float) -> float:
-        # Elo 期待値
-        try:
-            return 1.0 / (1.0 + 10 ** ((rb - ra) / 400.0))
-        except Exception:
-            # 極端な差など数値例外時の安全弁
-            if ra > rb:
-                return 0.99
-            return 0.01
-
-    def _k_factor(self, cfg: Dict[str, Any], rating: float, games_played: int) -> float:
+        # 期待値は cfg に依存しないので、整数レート差はモジュール共有の表を引く
+        d = rb - ra
+        if type(d) is int and -_EXPECTED_SPAN <= d <= _EXPECTED_SPAN:
+            return _EXPECTED_TABLE[d + _EXPECTED_SPAN]
+        return _expected_raw(ra, rb)
+
+    def _k_factor(self, cfg: _SystemCfg, rating: float, games_played: int) -> float:
         # ベース
-        k = float(cfg.get("k_base", 32))
+        k = cfg.k_base
         # 仮レート期間は大きめ（最低40）
-        if games_played < int(cfg.get("provisional_games", 0)):
+        if games_played < cfg.provisional_games:
             k = max(k, 40.0)
-        # 帯で調整（SC24 近似）
-        bands = cfg.get("k_bands", [])
+        # 帯で調整（SC24 近似）: 最初に当たる lt 帯、無ければ最後に当たる ge 帯
+        if cfg.lt_bisect is not None:
+            ths, ks = cfg.lt_bisect
+            i = bisect.bisect_right(ths, rating)
+            if i < len(ths):
+                return ks[i]
+            ths, ks = cfg.ge_bisect
+            i = bisect.bisect_right(ths, rating)
+            return ks[i - 1] if i else k
         last = k
-        for band in bands:
-            if "lt" in band and rating < band["lt"]:
-                return float(band["k"])
-            if "ge" in band and rating >= band["ge"]:
-                last = float(band["k"])
+        for lt, ge, band_k in cfg.k_bands:
+            if lt is not None and rating < lt:
+                return band_k
+            if ge is not None and rating >= ge:
+                last = band_k
         return last
 
-    def _apply_bounds(self, cfg: Dict[str, Any], rating: float) -> float:
+    def _apply_bounds(self, cfg: _SystemCfg, rating: float) -> float:
         # 下限0、上限は None なら無制限
-        min_r = cfg.get("min_rating", 0) or 0
-        rating = max(min_r, rating)
-        max_r = cfg.get("max_rating", None)
-        if isinstance(max_r, (int, float)):
-            rating = min(max_r, rating)
+        rating = max(cfg.min_rating, rating)
+        if cfg.max_rating is not None:
+            rating = min(cfg.max_rating, rating)
         return rating
 
     # ================== 計算API（新） ==================
@@ -105,8 +196,14 @@ class RatingService:
         games_a: int = 0, games_b: int = 0,
         rating_system: Optional[str] = None
     ) -> Tuple[int, int]:
-        """2人の新レーティングを返す（四捨五入）"""
+        """2人の新レーティングを返す（四捨五入、.5 は切り上げ）
+
+        SC24 プロファイル（または cfg の skip_large_gaps=True）では、
+        sc24_rating.should_skip_rating に該当する対局はレートを変えずに返す。
+        """
         cfg = self._pick_cfg(rating_system)
+        if cfg.skip_large_gaps and should_skip_rating(rating_a, rating_b, games_a, games_b):
+            return rating_a, rating_b
 
         exp_a = self._expected(rating_a, rating_b)
         exp_b = self._expected(rating_b, rating_a)
@@ -117,7 +214,7 @@ class RatingService:
             score_a, score_b = 0.0, 1.0
         else:
             # draw
-            score_a = score_b = float(cfg.get("draw_factor", 0.5))
+            score_a = score_b = cfg.draw_factor
 
         k_a = self._k_factor(cfg, rating_a, games_a)
         k_b = self._k_factor(cfg, rating_b, games_b)
@@ -125,7 +222,8 @@ class RatingService:
         new_a = self._apply_bounds(cfg, rating_a + k_a * (score_a - exp_a))
         new_b = self._apply_bounds(cfg, rating_b + k_b * (score_b - exp_b))
 
-        return int(round(new_a)), int(round(new_b))
+        # 四捨五入（round は偶数丸めなので使わない）
+        return math.floor(new_a + 0.5), math.floor(new_b + 0.5)
 
     # ================== DB更新API ==================
 
@@ -163,20 +261,14 @@ class RatingService:
             delta_w = new_w - ra
             delta_l = new_l - rb
 
-            # 反映
-            self.user_model.update_rating(winner_id, new_w)
-            self.user_model.update_rating(loser_id, new_l)
-
-            # 統計
+            # 反映（レートと戦績を両者まとめて1回で書く）
             if result == "win":
-                self.user_model.update_game_stats(winner_id, "win")
-                self.user_model.update_game_stats(loser_id, "loss")
+                stat_w, stat_l = "wins", "losses"
             elif result == "loss":
-                self.user_model.update_game_stats(loser_id, "win")
-                self.user_model.update_game_stats(winner_id, "loss")
+                stat_w, stat_l = "losses", "wins"
             else:
-                self.user_model.update_game_stats(winner_id, "draw")
-                self.user_model.update_game_stats(loser_id, "draw")
+                stat_w = stat_l = "draws"
+            self.user_model.bulk_update_after_game(winner_id, new_w, stat_w, loser_id, new_l, stat_l)
 
             return {
                 "success": True,
@@ -221,7 +313,7 @@ class RatingService:
         cfg = self._pick_cfg(rating_system)
         k = self._k_factor(cfg, current_rating, games_played)
         new_rating = self._apply_bounds(cfg, current_rating + k * (actual_score - expected_score))
-        return int(round(new_rating))
+        return math.floor(new_rating + 0.5)
 
     def get_rating_statistics(self, user_id: str) -> Dict[str, Any]:
         try:
@@ -258,36 +350,7 @@ class RatingService:
 
     def _get_rating_class(self, rating: int) -> Dict[str, str]:
         # （元の区分けを踏襲）
-        if rating >= 2800:
-            return {'name': '竜王', 'color': '#FFD700'}
-        elif rating >= 2600:
-            return {'name': '名人', 'color': '#FF6B35'}
-        elif rating >= 2400:
-            return {'name': '九段', 'color': '#FF1744'}
-        elif rating >= 2200:
-            return {'name': '八段', 'color': '#E91E63'}
-        elif rating >= 2000:
-            return {'name': '七段', 'color': '#9C27B0'}
-        elif rating >= 1800:
-            return {'name': '六段', 'color': '#673AB7'}
-        elif rating >= 1600:
-            return {'name': '五段', 'color': '#3F51B5'}
-        elif rating >= 1400:
-            return {'name': '四段', 'color': '#2196F3'}
-        elif rating >= 1200:
-            return {'name': '三段', 'color': '#03A9F4'}
-        elif rating >= 1000:
-            return {'name': '二段', 'color': '#00BCD4'}
-        elif rating >= 800:
-            return {'name': '初段', 'color': '#009688'}
-        elif rating >= 600:
-            return {'name': '1級', 'color': '#4CAF50'}
-        elif rating >= 400:
-            return {'name': '2級', 'color': '#8BC34A'}
-        elif rating >= 200:
-            return {'name': '3級', 'color': '#CDDC39'}
-        else:
-            return {'name': '4級', 'color': '#FFC107'}
+        return _RATING_CLASSES[bisect.bisect_right(_CLASS_THRESHOLDS, rating)]
 
     def get_leaderboard(self, limit: int = 50) -> Dict[str, Any]:
         try:
@@ -298,32 +361,45 @@ class RatingService:
                     {'$limit': int(limit)},
                     {'$project': {
                         'username': 1, 'rating': 1, 'games_played': 1,
-                        'wins': 1, 'losses': 1, 'draws': 1
+                        'wins': 1, 'losses': 1, 'draws': 1,
+                        # 勝率もサーバ側で計算（Python 側と同じく小数1桁、対局0なら 0.0）
+                        'win_rate': {'$cond': [
+                            {'$gt': ['$games_played', 0]},
+                            {'$round': [{'$multiply': [
+                                {'$divide': [{'$ifNull': ['$wins', 0]}, '$games_played']}, 100]}, 1]},
+                            0.0,
+                        ]},
                     }}
                 ]
                 cursor = self.db_manager.db.users.aggregate(pipeline)
                 users = list(cursor)
             else:
+                # 上位 limit 件だけを選び、出力 dict はその分だけ作る
+                min_games = int(self.provisional_games)
+                init = self.initial_rating
+                eligible = [
+                    u for u in self.db_manager.data.get('users', {}).values()
+                    if int(u.get('games_played', 0)) >= min_games
+                ]
+                top = heapq.nlargest(int(limit), eligible, key=lambda u: int(u.get('rating', init)))
                 users = []
-                for user in self.db_manager.data.get('users', {}).values():
-                    if int(user.get('games_played', 0)) >= int(self.provisional_games):
-                        users.append({
-                            'username': user.get('username'),
-                            'rating': int(user.get('rating', self.initial_rating)),
-                            'games_played': int(user.get('games_played', 0)),
-                            'wins': int(user.get('wins', 0)),
-                            'losses': int(user.get('losses', 0)),
-                            'draws': int(user.get('draws', 0)),
-                        })
-                users.sort(key=lambda x: x['rating'], reverse=True)
-                users = users[: int(limit)]
-
-            for i, user in enumerate(users):
-                user['rank'] = i + 1
+                for user in top:
+                    gp = int(user.get('games_played', 0))
+                    w = int(user.get('wins', 0))
+                    users.append({
+                        'username': user.get('username'),
+                        'rating': int(user.get('rating', init)),
+                        'games_played': gp,
+                        'wins': w,
+                        'losses': int(user.get('losses', 0)),
+                        'draws': int(user.get('draws', 0)),
+                        'win_rate': round((w / gp) * 100, 1) if gp > 0 else 0.0,
+                    })
+
+            # 順位と区分だけ付ける（win_rate は各経路で計算済み）
+            for i, user in enumerate(users, 1):
+                user['rank'] = i
                 user['rating_class'] = self._get_rating_class(int(user['rating']))
-                gp = int(user.get('games_played', 0))
-                w = int(user.get('wins', 0))
-                user['win_rate'] = round((w / gp) * 100, 1) if gp > 0 else 0.0
 
             return {'success': True, 'leaderboard': users, 'total_count': len(users)}
         except Exception as e:
@@ -341,10 +417,16 @@ class RatingService:
 
             history = []
             rating = int(self.initial_rating)
+            # 境界はループ外で一度だけ解決（各局ごとに下限/上限でクランプする点は従来どおり）
+            cfg = self._pick_cfg(None)
+            min_r, max_r = cfg.min_rating, cfg.max_rating
             for i in range(min(games_played, int(limit))):
                 change = (-20 + (i % 40)) if i % 3 == 0 else (10 - (i % 20))
                 rating += change
-                rating = int(self._apply_bounds(self._pick_cfg(None), rating))
+                if rating < min_r:
+                    rating = int(min_r)
+                elif max_r is not None and rating > max_r:
+                    rating = int(max_r)
                 history.append({
                     'game_number': i + 1,
                     'rating': rating,
@@ -383,20 +465,27 @@ class RatingService:
                 cursor = self.db_manager.db.users.find(query).limit(int(limit))
                 candidates = list(cursor)
             else:
+                # 先頭から limit 件集まった時点で打ち切る（従来の全件走査→スライスと同じ結果）
+                lim = int(limit)
+                init = self.initial_rating
                 for uid, cand in self.db_manager.data.get('users', {}).items():
                     if (uid != user_id
-                        and min_rating <= int(cand.get('rating', self.initial_rating)) <= max_rating
+                        and min_rating <= int(cand.get('rating', init)) <= max_rating
                         and cand.get('is_active', True)):
                         candidates.append(cand)
-                candidates = candidates[: int(limit)]
+                        if len(candidates) == lim:
+                            break
+                candidates = candidates[:lim]
 
+            # 候補は既に limit 件以下なので部分ソートは不要。スコアは dict に直接書き込み、
+            # ソートキーは書き込んだ値をそのまま使う
+            init = self.initial_rating
             for cand in candidates:
-                cr = int(cand.get('rating', self.initial_rating))
-                diff = abs(user_rating - cr)
+                diff = abs(user_rating - int(cand.get('rating', init)))
                 cand['recommendation_score'] = round(max(0.0, 100.0 - diff / 2.0), 1)
                 cand['rating_difference'] = diff
 
-            candidates.sort(key=lambda x: x['recommendation_score'], reverse=True)
+            candidates.sort(key=operator.itemgetter('recommendation_score'), reverse=True)
             return {'success': True, 'recommended_opponents': candidates}
         except Exception as e:
             return {'success': False, 'error_code': 'recommended_opponents_fetch_failed', 'message': '推奨対戦相手の取得に失敗しました'}
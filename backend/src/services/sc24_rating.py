@@ -30,6 +30,7 @@
 
 from __future__ import annotations
 
+import functools
 import math
 from dataclasses import dataclass
 from typing import Literal, Optional, Tuple
@@ -46,10 +47,11 @@ class RatingUpdate:
 
 
 def _round_half_away_from_zero(x: float) -> int:
-    """Python の round は 0.5 を偶数丸めするので、四捨五入を明示する。"""
-    if x >= 0:
-        return int(math.floor(x + 0.5))
-    return int(math.ceil(x - 0.5))
+    """Python の round は 0.5 を偶数丸めするので、四捨五入を明示する。
+
+    int() は 0 方向への切り捨てなので、符号側に 0.5 を足せば floor/ceil の分岐が要らない。
+    """
+    return int(x + math.copysign(0.5, x))
 
 
 def should_skip_rating(
@@ -76,8 +78,9 @@ def should_skip_rating(
     return None
 
 
+@functools.lru_cache(maxsize=4096)
 def _denominator(old_rating: int, games_played: int) -> Tuple[int, str]:
-    """分母と式種別を返す。"""
+    """分母と式種別を返す。（引数は有界な整数なので一括再計算向けにメモ化）"""
     r = int(old_rating)
     n = int(games_played)
     if r >= 2800:
@@ -90,53 +93,62 @@ def _denominator(old_rating: int, games_played: int) -> Tuple[int, str]:
     return 25, "normal"
 
 
-def compute_sc24_update(
-    *,
-    old_rating: int,
-    opponent_rating: int,
-    games_played: int,
-    result: Result,
-) -> RatingUpdate:
-    """単体プレイヤーの更新量を返す。"""
-    r0 = int(old_rating)
-    ro = int(opponent_rating)
-    n = int(games_played)
-
-    # draw は仕様提示が無いので「変動なし」に寄せる
-    if result == "draw":
-        return RatingUpdate(old_rating=r0, new_rating=r0, delta=0, formula="none")
+def _sc24_step(r0: int, ro: int, n: int, win: bool) -> Tuple[int, int, str]:
+    """勝敗付き1局分の (新R, 増減, 式種別)。
 
+    前提: 引数はすべて int（整数化と draw の扱いは呼び出し側で済ませる）。
+    """
     denom, formula = _denominator(r0, n)
-    bonus = 400 if result == "win" else -400
+    bonus = 400 if win else -400
     num = (ro - r0) + bonus
     raw = num / float(denom)
     delta = _round_half_away_from_zero(raw)
 
     # 下限（勝ち:+1 / 負け:-1）
-    if result == "win" and delta <= 0:
+    if win and delta <= 0:
         delta = 1
-    if result == "loss" and delta >= 0:
+    if not win and delta >= 0:
         delta = -1
 
     # 通常式の上限
     if denom == 25:
-        delta = max(-31, min(31, int(delta)))
+        delta = max(-31, min(31, delta))
 
     # 低レート特例（通常式のみ）
-    if denom == 25 and r0 <= 200 and result == "loss":
+    if denom == 25 and r0 <= 200 and not win:
         # 「半分」: 減りを弱める方向（負数は ceil で 0 方向へ寄せる）
         if abs(delta) >= 2:
-            delta = int(math.ceil(delta / 2.0))
+            delta = -(-delta // 2)
         # ただし負け下限は維持
         if delta == 0:
             delta = -1
 
-    r1 = r0 + int(delta)
+    r1 = r0 + delta
     if r1 < 0:
         r1 = 0
         delta = -r0
 
-    return RatingUpdate(old_rating=r0, new_rating=int(r1), delta=int(delta), formula=formula)
+    return r1, delta, formula
+
+
+def compute_sc24_update(
+    *,
+    old_rating: int,
+    opponent_rating: int,
+    games_played: int,
+    result: Result,
+) -> RatingUpdate:
+    """単体プレイヤーの更新量を返す。"""
+    r0 = int(old_rating)
+    ro = int(opponent_rating)
+    n = int(games_played)
+
+    # draw は仕様提示が無いので「変動なし」に寄せる
+    if result == "draw":
+        return RatingUpdate(old_rating=r0, new_rating=r0, delta=0, formula="none")
+
+    r1, delta, formula = _sc24_step(r0, ro, n, result == "win")
+    return RatingUpdate(old_rating=r0, new_rating=r1, delta=delta, formula=formula)
 
 
 def compute_match_updates(
@@ -152,23 +164,29 @@ def compute_match_updates(
     Returns:
       (sente_update, gote_update, skip_reason)
     """
+    # 整数化はここで一度だけ行い、以降は int 前提の _sc24_step を直接使う
+    rs = int(sente_rating)
+    rg = int(gote_rating)
+    gs = int(sente_games)
+    gg = int(gote_games)
+
     if winner_role not in ("sente", "gote"):
-        su = compute_sc24_update(old_rating=sente_rating, opponent_rating=gote_rating, games_played=sente_games, result="draw")
-        gu = compute_sc24_update(old_rating=gote_rating, opponent_rating=sente_rating, games_played=gote_games, result="draw")
+        # draw は仕様提示が無いので「変動なし」に寄せる
+        su = RatingUpdate(old_rating=rs, new_rating=rs, delta=0, formula="none")
+        gu = RatingUpdate(old_rating=rg, new_rating=rg, delta=0, formula="none")
         return su, gu, None
 
-    skip = should_skip_rating(sente_rating, gote_rating, sente_games, gote_games)
+    skip = should_skip_rating(rs, rg, gs, gg)
     if skip:
         # スキップ時は変動なし（ただし勝敗統計は別ロジックで処理）
-        su = RatingUpdate(old_rating=int(sente_rating), new_rating=int(sente_rating), delta=0, formula="none")
-        gu = RatingUpdate(old_rating=int(gote_rating), new_rating=int(gote_rating), delta=0, formula="none")
+        su = RatingUpdate(old_rating=rs, new_rating=rs, delta=0, formula="none")
+        gu = RatingUpdate(old_rating=rg, new_rating=rg, delta=0, formula="none")
         return su, gu, skip
 
-    if winner_role == "sente":
-        su = compute_sc24_update(old_rating=sente_rating, opponent_rating=gote_rating, games_played=sente_games, result="win")
-        gu = compute_sc24_update(old_rating=gote_rating, opponent_rating=sente_rating, games_played=gote_games, result="loss")
-    else:
-        su = compute_sc24_update(old_rating=sente_rating, opponent_rating=gote_rating, games_played=sente_games, result="loss")
-        gu = compute_sc24_update(old_rating=gote_rating, opponent_rating=sente_rating, games_played=gote_games, result="win")
+    sente_win = winner_role == "sente"
+    s1, sd, sf = _sc24_step(rs, rg, gs, sente_win)
+    g1, gd, gf = _sc24_step(rg, rs, gg, not sente_win)
+    su = RatingUpdate(old_rating=rs, new_rating=s1, delta=sd, formula=sf)
+    gu = RatingUpdate(old_rating=rg, new_rating=g1, delta=gd, formula=gf)
 
     return su, gu, None
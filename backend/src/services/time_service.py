@@ -11,57 +11,186 @@ from typing import Dict, Any, Optional, Callable
 import logging
 
 from src.models.database import DatabaseManager
+try:
+    from pymongo import UpdateOne
+except Exception:  # pragma: no cover
+    UpdateOne = None
 from src.config import TIME_CONTROLS
 
 logger = logging.getLogger(__name__)
 
+# 時間更新通知（time_update）の間隔（秒）
+_TIME_UPDATE_INTERVAL = 10.0
+
+# 削除したタイマーを再利用のために保持する上限
+_TIMER_POOL_MAX = 512
+
+# time_state の DB 書き込みをまとめる間隔（秒）
+_TIME_STATE_FLUSH_SEC = 2.0
+
+
+class _TimerWheel:
+    """全ゲーム共通のタイミングホイール。
+
+    各 GameTimer は「次に何か起きる時刻」（time_update / 秒読み開始 / 時間切れ）だけを
+    バケット（deadline_ms // bucket_ms）に登録し、1本のデーモンスレッドが
+    到来したバケットをまとめて処理する。ゲーム数によらずスレッドは1本。
+    取り消しはトークン不一致で捨てる（tombstone）。
+    """
+
+    def __init__(self, bucket_ms: int = 100):
+        self.bucket_ms = int(bucket_ms)
+        self._buckets: Dict[int, list] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._cursor: Optional[int] = None  # 次に処理するバケット番号
+
+    def _index(self, deadline: float) -> int:
+        # 切り上げ: 期限より前のバケットで発火させない
+        return -(-int(deadline * 1000) // self.bucket_ms)
+
+    def schedule(self, deadline: float, timer: 'GameTimer', token: int):
+        """monotonic 秒の deadline に timer._on_wheel(token) を呼ぶよう登録する。"""
+        idx = self._index(deadline)
+        with self._lock:
+            if self._cursor is not None and idx < self._cursor:
+                idx = self._cursor
+            self._buckets.setdefault(idx, []).append((timer, token))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='game-timer-wheel')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        tick = self.bucket_ms / 1000.0
+        while True:
+            with self._lock:
+                idle = not self._buckets
+                if idle:
+                    self._cursor = None
+            if idle:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            time.sleep(tick)
+            # 切り捨て: バケット i（期限 <= i * bucket_ms）は now がそこに達してから処理する
+            now_idx = int(time.monotonic() * 1000) // self.bucket_ms
+            due = []
+            with self._lock:
+                cursor = self._cursor
+                if cursor is None:
+                    # アイドル明けは現在時刻のバケットから（期限切れの予約があればそこから）。
+                    # 最も早い予約（多くは +10 秒の time_update）から始めると、
+                    # それより前の期限が schedule でカーソルまで繰り下げられてしまう
+                    cursor = min(min(self._buckets), now_idx)
+                for i in range(cursor, now_idx + 1):
+                    entries = self._buckets.pop(i, None)
+                    if entries:
+                        due.extend(entries)
+                self._cursor = max(cursor, now_idx + 1)
+
+            for timer, token in due:
+                try:
+                    timer._on_wheel(token)
+                except Exception as e:
+                    logger.error(f"タイマーホイール処理エラー: {e}")
+
+
+_default_wheel: Optional[_TimerWheel] = None
+_default_wheel_lock = threading.Lock()
+
+
+def _get_default_wheel() -> _TimerWheel:
+    global _default_wheel
+    if _default_wheel is None:
+        with _default_wheel_lock:
+            if _default_wheel is None:
+                _default_wheel = _TimerWheel()
+    return _default_wheel
+
+
+# 手番の文字列は API の入口で一度だけ添字に変換し、内部状態は2要素リストで持つ
+_PLAYERS = ('sente', 'gote')
+_PLAYER_INDEX = {'sente': 0, 'gote': 1}
+
 
 class GameTimer:
     """個別ゲームの時間管理"""
     
-    def __init__(self, game_id: str, time_control: str, callback: Optional[Callable] = None):
-        self.game_id = game_id
-        self.time_control = time_control
+    def __init__(self, game_id: str, time_control: str, callback: Optional[Callable] = None,
+                 wheel: Optional[_TimerWheel] = None):
+        # ホイールのスレッドと API 側の呼び出しが同じ状態を触るので排他する。
+        # stop_timer を start_timer から呼ぶなど再入があるので RLock
+        self._lock = threading.RLock()
+
+        # 期限処理は共有ホイールに任せる（ゲーム毎のスレッドは持たない）
+        self._wheel = wheel or _get_default_wheel()
+        self._wheel_token = 0
+
+        self.reset(game_id, time_control, callback)
+
+    def reset(self, game_id: str, time_control: str, callback: Optional[Callable] = None):
+        """状態を初期化する（TimeService のプールから再利用するときにも使う）。
+
+        lock / wheel はそのまま使い回し、ホイール上の古い予約はトークン更新で無効化する。
+        """
         info = TIME_CONTROLS.get(time_control)
         if not info:
             raise ValueError(f"Unknown time_control: {time_control}")
-        self.time_control_info = info
-        self.callback = callback
-        
-        # 時間状態
-        self.sente_time_left = self.time_control_info['initial_time']
-        self.gote_time_left = self.time_control_info['initial_time']
-        self.sente_byoyomi_count = 0
-        self.gote_byoyomi_count = 0
-        
-        # タイマー状態
-        self.current_player = 'sente'
-        self.is_running = False
-        self.is_in_byoyomi = False
-        self.move_start_time = None
-        self.timer_thread = None
-        self.stop_event = threading.Event()
-        
-        # 秒読み設定
-        self.byoyomi_time = self.time_control_info['byoyomi_time']
-        self.grace_period = 3  # 秒読み後の猶予時間（3秒）
+        with self._lock:
+            self._wheel_token += 1
+            self.game_id = game_id
+            self.time_control = time_control
+            self.time_control_info = info
+            self.callback = callback
+
+            # 時間状態
+            initial = self.time_control_info['initial_time']
+            self.time_left = [initial, initial]  # [sente, gote]
+            self.byoyomi_count = [0, 0]
+
+            # タイマー状態
+            self.current_player_idx = 0
+            self.is_running = False
+            self.is_in_byoyomi = False
+            # 手番開始時刻（time.monotonic()。壁時計の補正で持ち時間がずれないように）
+            self.move_start_monotonic: Optional[float] = None
+            self._next_update_at = _TIME_UPDATE_INTERVAL  # 次の time_update（手番開始からの経過秒）
+
+            # 秒読み設定
+            self.byoyomi_time = self.time_control_info['byoyomi_time']
+            self.grace_period = 3  # 秒読み後の猶予時間（3秒）
+
+            # get_time_state の不変部分（手番・秒読み回数が変わるまで使い回す）
+            self._state_template: Optional[Dict[str, Any]] = None
+
+    @property
+    def current_player(self) -> str:
+        return _PLAYERS[self.current_player_idx]
+
+    @current_player.setter
+    def current_player(self, player: str):
+        # 'sente' 以外は従来どおり後手扱い
+        self.current_player_idx = _PLAYER_INDEX.get(player, 1)
     
     def start_timer(self, player: str):
         """指定プレイヤーの時間計測開始"""
         try:
-            if self.is_running:
-                self.stop_timer()
+            with self._lock:
+                if self.is_running:
+                    self.stop_timer()
             
-            self.current_player = player
-            self.is_running = True
-            self.move_start_time = datetime.utcnow()
+                self.current_player = player
+                self._state_template = None
+                self.is_running = True
+                self.move_start_monotonic = time.monotonic()
+                self._next_update_at = _TIME_UPDATE_INTERVAL
+                self._arm()
             
-            # タイマースレッド開始
-            self.timer_thread = threading.Thread(target=self._timer_loop)
-            self.timer_thread.daemon = True
-            self.timer_thread.start()
-            
-            logger.info(f"タイマー開始: game {self.game_id}, player {player}")
+                logger.info(f"タイマー開始: game {self.game_id}, player {player}")
             
         except Exception as e:
             logger.error(f"タイマー開始エラー: {e}")
@@ -69,121 +198,142 @@ class GameTimer:
     def stop_timer(self):
         """時間計測停止"""
         try:
-            if not self.is_running:
-                return
+            with self._lock:
+                if not self.is_running:
+                    return
             
-            self.is_running = False
-            self.stop_event.set()
-            
-            if self.timer_thread and self.timer_thread.is_alive():
-                self.timer_thread.join(timeout=1.0)
+                self.is_running = False
+                # ホイール上の予約を無効化
+                self._wheel_token += 1
             
-            # 使用時間を計算して減算
-            if self.move_start_time:
-                elapsed = (datetime.utcnow() - self.move_start_time).total_seconds()
-                self._consume_time(elapsed)
+                # 使用時間を計算して減算
+                if self.move_start_monotonic is not None:
+                    self._consume_time(self._elapsed())
             
-            self.move_start_time = None
-            self.stop_event.clear()
+                self.move_start_monotonic = None
             
-            logger.info(f"タイマー停止: game {self.game_id}")
+                logger.info(f"タイマー停止: game {self.game_id}")
             
         except Exception as e:
             logger.error(f"タイマー停止エラー: {e}")
     
     def switch_player(self, next_player: str):
         """プレイヤー切り替え"""
-        try:
+        with self._lock:
             if self.is_running:
                 # 現在のプレイヤーの時間を更新
-                if self.move_start_time:
-                    elapsed = (datetime.utcnow() - self.move_start_time).total_seconds()
-                    self._consume_time(elapsed)
-                
+                if self.move_start_monotonic is not None:
+                    self._consume_time(self._elapsed())
+            
                 # 次のプレイヤーに切り替え
                 self.current_player = next_player
-                self.move_start_time = datetime.utcnow()
+                self._state_template = None
+                self.move_start_monotonic = time.monotonic()
                 self.is_in_byoyomi = False
-                
+                self._next_update_at = _TIME_UPDATE_INTERVAL
+            
                 # 秒読み状態をリセット
-                if next_player == 'sente':
-                    self.sente_byoyomi_count = 0
-                else:
-                    self.gote_byoyomi_count = 0
-                
-                logger.info(f"プレイヤー切り替え: game {self.game_id}, next {next_player}")
+                self.byoyomi_count[self.current_player_idx] = 0
             
-        except Exception as e:
-            logger.error(f"プレイヤー切り替えエラー: {e}")
-    
+                self._arm()
+
+                logger.info(f"プレイヤー切り替え: game {self.game_id}, next {next_player}")
+
     def _consume_time(self, elapsed_seconds: float):
         """時間を消費"""
-        try:
-            if self.current_player == 'sente':
-                if self.sente_time_left > 0:
-                    # 持ち時間から消費
-                    self.sente_time_left = max(0, self.sente_time_left - elapsed_seconds)
-                else:
-                    # 秒読み中
-                    self.is_in_byoyomi = True
-                    if elapsed_seconds > self.byoyomi_time + self.grace_period:
-                        self.sente_byoyomi_count += 1
+        idx = self.current_player_idx
+        if self.time_left[idx] > 0:
+            # 持ち時間から消費
+            self.time_left[idx] = max(0, self.time_left[idx] - elapsed_seconds)
+        else:
+            # 秒読み中
+            self.is_in_byoyomi = True
+            if elapsed_seconds > self.byoyomi_time + self.grace_period:
+                self.byoyomi_count[idx] += 1
+                self._state_template = None
+
+    def _elapsed(self) -> float:
+        """現在の手番の経過秒"""
+        return time.monotonic() - self.move_start_monotonic
+
+    def _arm(self):
+        """次に処理が必要な時刻をホイールに登録する（以前の予約は無効化）"""
+        self._wheel_token += 1
+        if not self.is_running or self.move_start_monotonic is None:
+            return
+        elapsed = self._elapsed()
+        due = self._next_update_at
+        if self._get_current_time_left() <= 0:
+            if not self.is_in_byoyomi:
+                # 秒読み開始はすぐ通知
+                due = elapsed
             else:
-                if self.gote_time_left > 0:
-                    # 持ち時間から消費
-                    self.gote_time_left = max(0, self.gote_time_left - elapsed_seconds)
-                else:
-                    # 秒読み中
-                    self.is_in_byoyomi = True
-                    if elapsed_seconds > self.byoyomi_time + self.grace_period:
-                        self.gote_byoyomi_count += 1
-            
-        except Exception as e:
-            logger.error(f"時間消費エラー: {e}")
-    
-    def _timer_loop(self):
-        """タイマーループ"""
+                # 時間切れは byoyomi + 猶予を超えた時点
+                due = min(due, self.byoyomi_time + self.grace_period + 0.001)
+        self._wheel.schedule(time.monotonic() + max(0.0, due - elapsed), self, self._wheel_token)
+
+    def _on_wheel(self, token: int):
+        """ホイールからの呼び出し（旧 _timer_loop の1回分）
+
+        判定と状態更新はロック内で行い、コールバック（DB 更新など）はロック外で呼ぶ。
+        """
         try:
-            while self.is_running and not self.stop_event.is_set():
-                time.sleep(1)  # 1秒間隔で更新
-                
-                if not self.is_running or not self.move_start_time:
-                    continue
-                
-                # 経過時間計算
-                elapsed = (datetime.utcnow() - self.move_start_time).total_seconds()
+            events = []
+            timeout_data = None
+            with self._lock:
+                if token != self._wheel_token or not self.is_running or self.move_start_monotonic is None:
+                    return
+                # ロック外で使う値はここで確定させる（プール返却→reset で別ゲームに変わりうる）
+                callback = self.callback
+
+                elapsed = self._elapsed()
                 current_time_left = self._get_current_time_left()
-                
+
                 # 時間切れチェック
                 if self._is_time_up(elapsed):
-                    self._handle_timeout()
-                    break
-                
-                # 秒読み開始チェック
-                if current_time_left <= 0 and not self.is_in_byoyomi:
-                    self.is_in_byoyomi = True
-                    if self.callback:
-                        self.callback('byoyomi_start', {
+                    self.is_running = False
+                    timeout_data = {
+                        'game_id': self.game_id,
+                        'player': self.current_player,
+                        'winner': _PLAYERS[1 - self.current_player_idx]
+                    }
+                else:
+                    # 秒読み開始チェック
+                    if current_time_left <= 0 and not self.is_in_byoyomi:
+                        self.is_in_byoyomi = True
+                        events.append(('byoyomi_start', {
                             'game_id': self.game_id,
                             'player': self.current_player
-                        })
-                
-                # 時間更新通知（10秒間隔）
-                if int(elapsed) % 10 == 0 and self.callback:
-                    self.callback('time_update', {
-                        'game_id': self.game_id,
-                        'time_state': self.get_time_state()
-                    })
-            
+                        }))
+
+                    # 時間更新通知（10秒間隔）
+                    if elapsed >= self._next_update_at:
+                        while self._next_update_at <= elapsed:
+                            self._next_update_at += _TIME_UPDATE_INTERVAL
+                        events.append(('time_update', {
+                            'game_id': self.game_id,
+                            'time_state': self.get_time_state()
+                        }))
+
+            if timeout_data is not None:
+                self._handle_timeout(timeout_data, callback)
+                return
+
+            if callback:
+                for event_type, data in events:
+                    callback(event_type, data)
+
+            # コールバック内で停止・切り替えされていなければ再登録
+            with self._lock:
+                if token == self._wheel_token:
+                    self._arm()
+
         except Exception as e:
             logger.error(f"タイマーループエラー: {e}")
-    
+
     def _get_current_time_left(self) -> float:
         """現在のプレイヤーの残り時間取得"""
-        if self.current_player == 'sente':
-            return self.sente_time_left
-        else:
-            return self.gote_time_left
+        return self.time_left[self.current_player_idx]
     
     def _is_time_up(self, elapsed: float) -> bool:
         """時間切れかどうかチェック"""
@@ -196,56 +346,49 @@ class GameTimer:
             # 秒読み中
             return elapsed > self.byoyomi_time + self.grace_period
     
-    def _handle_timeout(self):
-        """時間切れ処理"""
+    def _handle_timeout(self, data: Dict[str, Any], callback: Optional[Callable]):
+        """時間切れ処理（data / callback は _on_wheel がロック内で確定させたもの）"""
         try:
-            self.is_running = False
+            if callback:
+                callback('timeout', data)
             
-            if self.callback:
-                self.callback('timeout', {
-                    'game_id': self.game_id,
-                    'player': self.current_player,
-                    'winner': 'gote' if self.current_player == 'sente' else 'sente'
-                })
-            
-            logger.info(f"時間切れ: game {self.game_id}, player {self.current_player}")
+            logger.info(f"時間切れ: game {data['game_id']}, player {data['player']}")
             
         except Exception as e:
             logger.error(f"時間切れ処理エラー: {e}")
     
     def get_time_state(self) -> Dict[str, Any]:
         """現在の時間状態取得"""
-        try:
+        with self._lock:
             # 現在の経過時間を考慮した残り時間計算
             current_elapsed = 0
-            if self.is_running and self.move_start_time:
-                current_elapsed = (datetime.utcnow() - self.move_start_time).total_seconds()
-            
+            if self.is_running and self.move_start_monotonic is not None:
+                current_elapsed = self._elapsed()
+        
             # 現在のプレイヤーの残り時間を調整
-            sente_display_time = self.sente_time_left
-            gote_display_time = self.gote_time_left
-            
-            if self.is_running and self.current_player == 'sente':
-                sente_display_time = max(0, self.sente_time_left - current_elapsed)
-            elif self.is_running and self.current_player == 'gote':
-                gote_display_time = max(0, self.gote_time_left - current_elapsed)
-            
+            display = list(self.time_left)
+            if self.is_running:
+                idx = self.current_player_idx
+                display[idx] = max(0, display[idx] - current_elapsed)
+        
+            template = self._state_template
+            if template is None:
+                template = self._state_template = {
+                    'sente_byoyomi_count': self.byoyomi_count[0],
+                    'gote_byoyomi_count': self.byoyomi_count[1],
+                    'current_player': self.current_player,
+                    'byoyomi_time': self.byoyomi_time,
+                    'time_control': self.time_control_info
+                }
+
             return {
-                'sente_time_left': sente_display_time,
-                'gote_time_left': gote_display_time,
-                'sente_byoyomi_count': self.sente_byoyomi_count,
-                'gote_byoyomi_count': self.gote_byoyomi_count,
-                'current_player': self.current_player,
+                'sente_time_left': display[0],
+                'gote_time_left': display[1],
                 'is_running': self.is_running,
                 'is_in_byoyomi': self.is_in_byoyomi,
-                'byoyomi_time': self.byoyomi_time,
-                'time_control': self.time_control_info
+                **template
             }
-            
-        except Exception as e:
-            logger.error(f"時間状態取得エラー: {e}")
-            return {}
-    
+
     def pause(self):
         """タイマー一時停止"""
         if self.is_running:
@@ -258,16 +401,10 @@ class GameTimer:
     
     def add_time(self, player: str, seconds: int):
         """時間追加（切れ負け救済など）"""
-        try:
-            if player == 'sente':
-                self.sente_time_left += seconds
-            else:
-                self.gote_time_left += seconds
-            
+        with self._lock:
+            self.time_left[_PLAYER_INDEX.get(player, 1)] += seconds
+        
             logger.info(f"時間追加: game {self.game_id}, player {player}, +{seconds}秒")
-            
-        except Exception as e:
-            logger.error(f"時間追加エラー: {e}")
 
 
 class TimeService:
@@ -279,6 +416,15 @@ class TimeService:
         
         # アクティブなタイマー管理
         self.active_timers: Dict[str, GameTimer] = {}
+        # 全タイマーの期限処理を1本のスレッドでまとめる
+        self._wheel = _TimerWheel()
+        # remove_timer で返却されたタイマー（create_timer で reset して再利用）
+        self._timer_pool: list = []
+
+        # time_update の DB 書き込みはゲーム毎に最新だけ保持し、まとめて書く
+        self._pending_updates: Dict[str, Dict[str, Any]] = {}  # game_id -> time_state
+        self._pending_lock = threading.Lock()
+        self._flush_thread: Optional[threading.Thread] = None
         
         # コールバック関数
         self.event_callbacks: Dict[str, Callable] = {}
@@ -294,12 +440,21 @@ class TimeService:
                 # 既存のタイマーを停止
                 self.stop_timer(game_id)
             
-            # 新しいタイマー作成
-            timer = GameTimer(
-                game_id=game_id,
-                time_control=time_control,
-                callback=self._handle_timer_event
-            )
+            # プールにあれば再利用、無ければ新規作成
+            if self._timer_pool:
+                timer = self._timer_pool.pop()
+                try:
+                    timer.reset(game_id, time_control, self._handle_timer_event)
+                except Exception:
+                    self._timer_pool.append(timer)
+                    raise
+            else:
+                timer = GameTimer(
+                    game_id=game_id,
+                    time_control=time_control,
+                    callback=self._handle_timer_event,
+                    wheel=self._wheel
+                )
             
             self.active_timers[game_id] = timer
             
@@ -422,6 +577,11 @@ class TimeService:
                 timer = self.active_timers[game_id]
                 timer.stop_timer()
                 del self.active_timers[game_id]
+
+                # 返却（コールバックは外して古い参照を残さない）
+                timer.callback = None
+                if len(self._timer_pool) < _TIMER_POOL_MAX:
+                    self._timer_pool.append(timer)
                 
                 logger.info(f"タイマー削除: game {game_id}")
             
@@ -486,22 +646,57 @@ class TimeService:
             logger.error(f"秒読み開始処理エラー: {e}")
     
     def _handle_time_update(self, event_data: Dict):
-        """時間更新処理"""
+        """時間更新処理（書き込みは _flush_time_updates でまとめて行う）"""
         try:
             game_id = event_data['game_id']
             time_state = event_data['time_state']
             
-            # データベースの時間情報を更新
-            update_data = {
-                'time_state': time_state,
-                'last_time_update': datetime.utcnow().isoformat()
-            }
-            
-            self.game_model.update_game(game_id, update_data)
+            # データベースの時間情報を更新（同じゲームは最新で上書き）
+            # last_time_update は書き込み時にまとめて1回だけ作る
+            with self._pending_lock:
+                self._pending_updates[game_id] = time_state
+                if self._flush_thread is None:
+                    self._flush_thread = threading.Thread(target=self._flush_loop, name='time-state-flush')
+                    self._flush_thread.daemon = True
+                    self._flush_thread.start()
             
         except Exception as e:
             logger.error(f"時間更新処理エラー: {e}")
     
+    def _flush_loop(self):
+        """保留中の time_state を定期的に書き込む。保留が無くなったら終了する。"""
+        while True:
+            time.sleep(_TIME_STATE_FLUSH_SEC)
+            self._flush_time_updates()
+            with self._pending_lock:
+                if not self._pending_updates:
+                    self._flush_thread = None
+                    return
+    
+    def _flush_time_updates(self):
+        """保留中の time_state を1回の bulk_write（不可なら1件ずつ）で書き込む"""
+        with self._pending_lock:
+            pending, self._pending_updates = self._pending_updates, {}
+        if not pending:
+            return
+        now_iso = datetime.utcnow().isoformat()
+        try:
+            col = getattr(self.db_manager, 'games', None)
+            if col is not None and UpdateOne is not None and hasattr(col, 'bulk_write'):
+                col.bulk_write(
+                    [UpdateOne({'_id': gid}, {'$set': {'time_state': st, 'last_time_update': now_iso}})
+                     for gid, st in pending.items()],
+                    ordered=False
+                )
+                return
+            for gid, st in pending.items():
+                try:
+                    self.game_model.update_game(gid, {'time_state': st, 'last_time_update': now_iso})
+                except Exception as e:
+                    logger.error(f"時間更新処理エラー: {e}")
+        except Exception as e:
+            logger.error(f"時間更新一括書き込みエラー: {e}")
+    
     def get_all_active_timers(self) -> Dict[str, Dict]:
         """全アクティブタイマー状態取得"""
         try:
@@ -21,11 +21,21 @@ def _port_open(host: str, port: int) -> bool:
     test_host = host
     if host in ("0.0.0.0", "::", "0:0:0:0:0:0:0:0"):
         test_host = "127.0.0.1"
+    # connect_ex: 接続できない場合も例外を作らずエラーコードで判定する。
+    # localhost など複数のアドレスに解決される名前は getaddrinfo の全候補（IPv4/IPv6）を試す
     try:
-        with socket.create_connection((test_host, port), timeout=0.3):
-            return True
+        infos = socket.getaddrinfo(test_host, int(port), type=socket.SOCK_STREAM)
     except Exception:
         return False
+    for family, socktype, proto, _canon, addr in infos:
+        try:
+            with socket.socket(family, socktype, proto) as sock:
+                sock.settimeout(0.3)
+                if sock.connect_ex(addr) == 0:
+                    return True
+        except Exception:
+            continue
+    return False
 
 
 def start_admin_server_process() -> Optional[subprocess.Popen]:
@@ -70,12 +80,15 @@ def start_admin_server_process() -> Optional[subprocess.Popen]:
         return None
 
     # Wait for port open (best-effort)
+    # monotonic で期限を測り、間隔は 0.02s から 0.5s まで指数的に伸ばす
     timeout_sec = float(os.getenv("ADMIN_SITE_STARTUP_TIMEOUT_SEC", "5"))
-    t0 = time.time()
-    while time.time() - t0 < timeout_sec:
+    deadline = time.monotonic() + max(0.0, timeout_sec)
+    delay = 0.02
+    while time.monotonic() < deadline:
         if _port_open(host, port):
             break
-        time.sleep(0.1)
+        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 1.5, 0.5)
 
     def _cleanup():
         global _ADMIN_PROC
@@ -2,15 +2,59 @@
 """小さなユーティリティ: 非同期/同期を気にせず呼び出すためのラッパー。Flask[async]不要。"""
 from __future__ import annotations
 
-import inspect
+import atexit
 import asyncio
+import threading
+
+# スレッド毎に使い回すイベントループ（呼び出しの度に asyncio.run で作り直さない）
+_local = threading.local()
+
+
+class _LoopHolder:
+    """スレッドローカルに置くループの持ち主。
+
+    スレッド終了でスレッドローカルが破棄されるとループも閉じる
+    （短命スレッドごとに epoll fd / self-pipe が残らないように）。
+    """
+    __slots__ = ('loop',)
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+
+    def close(self):
+        loop = self.loop
+        try:
+            if not loop.is_closed() and not loop.is_running():
+                loop.close()
+        except Exception:
+            pass
+
+    def __del__(self):
+        self.close()
+
+
+def _thread_loop() -> asyncio.AbstractEventLoop:
+    holder = getattr(_local, 'holder', None)
+    if holder is None or holder.loop.is_closed():
+        holder = _local.holder = _LoopHolder()
+    return holder.loop
+
+
+@atexit.register
+def _close_main_loop():
+    # 終了時まで生きているのは atexit を実行するメインスレッドのループだけ
+    holder = getattr(_local, 'holder', None)
+    if holder is not None:
+        holder.close()
+
 
 def run_maybe_awaitable(func, *args, **kwargs):
-    """func(*args, **kwargs) がコルーチンなら asyncio.run() で実行して結果を返す。
+    """func(*args, **kwargs) がコルーチンならスレッド毎のイベントループで実行して結果を返す。
     同期関数ならそのまま返す。Flask側の ensure_sync を使わないので 'async extra' は不要。
     """
     result = func(*args, **kwargs)
-    if inspect.isawaitable(result):
+    # 同期関数の戻り値（大半）は型チェックだけで抜ける
+    if asyncio.iscoroutine(result) or hasattr(result, '__await__'):
         # FlaskのWSGI環境では通常イベントループは走っていないはず
-        return asyncio.run(result)
+        return _thread_loop().run_until_complete(result)
     return result
@@ -2,7 +2,9 @@
 """Time helpers that are timezone-safe across server TZ settings.
 
 Rules:
-- Generate epoch seconds/milliseconds from time.time() (never from naive datetime.timestamp()).
+- Generate epoch seconds/milliseconds from time.time_ns() (never from naive datetime.timestamp()).
+- In-process intervals (e.g. GameTimer's current move) use time.monotonic(); stored timestamps such as
+  time_state.base_at stay epoch ms, since they must survive restarts and be shared across processes.
 - When converting datetime -> epoch, treat naive datetimes as UTC explicitly.
 """
 from __future__ import annotations
@@ -13,11 +15,12 @@ from typing import Optional
 
 
 def epoch_s() -> int:
-    return int(time.time())
+    return time.time_ns() // 1_000_000_000
 
 
 def epoch_ms() -> int:
-    return int(time.time() * 1000)
+    # 整数演算のみ（float を経由しない）
+    return time.time_ns() // 1_000_000
 
 
 def utc_now() -> datetime:
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from flask import current_app
+from flask import current_app, g
 
 class DatabaseNotFound(RuntimeError):
     pass
@@ -13,4 +13,9 @@ def get_db_from_app(app):
     return db
 
 def get_db():
-    return get_db_from_app(current_app)
\ No newline at end of file
+    # 同じリクエスト（app context）内では g に保持したハンドルを使い回す
+    db = getattr(g, '_mongo_db', None)
+    if db is None:
+        db = get_db_from_app(current_app)
+        g._mongo_db = db
+    return db
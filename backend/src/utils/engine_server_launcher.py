@@ -17,11 +17,21 @@ _ENGINE_PROC: Optional[subprocess.Popen] = None
 
 
 def _port_open(host: str, port: int) -> bool:
+    # connect_ex: 接続できない場合も例外を作らずエラーコードで判定する。
+    # localhost など複数のアドレスに解決される名前は getaddrinfo の全候補（IPv4/IPv6）を試す
     try:
-        with socket.create_connection((host, int(port)), timeout=0.3):
-            return True
+        infos = socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)
     except Exception:
         return False
+    for family, socktype, proto, _canon, addr in infos:
+        try:
+            with socket.socket(family, socktype, proto) as sock:
+                sock.settimeout(0.3)
+                if sock.connect_ex(addr) == 0:
+                    return True
+        except Exception:
+            continue
+    return False
 
 
 def start_engine_server_process() -> Optional[subprocess.Popen]:
@@ -69,8 +79,10 @@ def start_engine_server_process() -> Optional[subprocess.Popen]:
 
     # 起動を待つ（main.py のワーカーが先に叩いて ECONNREFUSED になるのを防ぐ）
     timeout_sec = float(os.getenv("ENGINE_SERVER_STARTUP_TIMEOUT_SEC", "8"))
-    deadline = time.time() + max(0.0, timeout_sec)
-    while time.time() < deadline:
+    # monotonic で期限を測り、間隔は 0.02s から 0.5s まで指数的に伸ばす
+    deadline = time.monotonic() + max(0.0, timeout_sec)
+    delay = 0.02
+    while time.monotonic() < deadline:
         if _port_open(bind, port):
             break
         # 早期終了した場合は待っても意味がない
@@ -78,7 +90,8 @@ def start_engine_server_process() -> Optional[subprocess.Popen]:
             logger.warning("Engine server exited early (code=%s)", _ENGINE_PROC.returncode)
             _ENGINE_PROC = None
             return None
-        time.sleep(0.2)
+        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 1.5, 0.5)
 
     if not _port_open(bind, port):
         logger.warning("Engine server did not become ready within %.1fs (%s:%s)", timeout_sec, bind, port)